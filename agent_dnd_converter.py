@@ -1,20 +1,27 @@
+import json
 import operator
 from dotenv import load_dotenv
-from typing import Annotated, TypedDict
+from typing import Annotated, Any, Iterator, Optional, TypedDict
 
+import time
+from uuid import UUID
+from langchain_core.caches import BaseCache
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.load import dumps, loads
 from langchain_core.messages import (
     SystemMessage,
 )
-from langchain_openai import ChatOpenAI
-from langchain_ollama import ChatOllama
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import END, StateGraph
-from llm_prompts import TYPE_PROMPT_TEMPLATE, OBJECT_TEMPLATE, SIMILAR_OBJECTS_TEMPLATE, REFLECTION_PROMPT, REFLECT_OBJECT_TEMPLATE
-from dnd_classes import DnDType, DND_MAP
-from config import openai_llm, ollama_llm, use_local_llm, dnd_converter_outputs_name
-from pathlib import Path
-import pandas as pd
-from rag_tools import retrieve_similar_objects
+from llm_prompts import TYPE_PROMPT_TEMPLATE, OBJECT_TEMPLATE, TYPED_OBJECT_TEMPLATE, SIMILAR_OBJECTS_TEMPLATE, REFLECTION_PROMPT, REFLECT_OBJECT_TEMPLATE
+from dnd_classes import DnDType, DnDTypedObject, ReflectionVerdict, DND_MAP
+from config import fused_classify_generate, speculative_retrieval, speculative_retrieval_types, retrieval_same_system_only, prompt_examples_token_budget
+from output_store import get_output_store
+from prompt_format import examples_prompt, stat_block_prompt
+from llm_cache import LLMCache, llm_cache
+from metrics import metrics, timed_node
+import threading
+import uuid
+from pydantic import BaseModel
 
 load_dotenv()
 
@@ -24,25 +31,124 @@ class AgentState(TypedDict):
     dnd_type: str
     dnd_system: str
     similar_objects: dict[str] 
+    speculative_objects: dict[str, list]
     draft: str
     critique: str
+    score: int
+    best_draft: str
+    best_score: int
+    stop_reason: str
+    revisions_saved: int
+    prompt_tokens_saved: Annotated[int, operator.add]
     revision_number: int
     max_revisions: int
     count: Annotated[int, operator.add]
 
 
+class LangChainLLMCache(BaseCache):
+    """
+    Adapter storing LangChain chat model generations in the shared LLMCache.
+    The llm_string LangChain passes in already holds the model name, temperature and any structured output schema.
+    """
+    def __init__(self, cache: LLMCache):
+        self.cache = cache
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[list]:
+        cached = self.cache.get(self.cache.make_key(llm_string=llm_string, prompt=prompt))
+        if cached is None:
+            return None
+        generations = [loads(generation) for generation in json.loads(cached)]
+        for generation in generations:
+            # Lets MetricsCallbackHandler tell cache hits from calls that reached the provider
+            if getattr(generation, "message", None) is not None:
+                generation.message.response_metadata["from_cache"] = True
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: list) -> None:
+        generations = []
+        for generation in return_val:
+            # OpenAI structured outputs keep the parsed pydantic object on the message, which cannot be serialised.
+            # Store it as a dict, the structured output parser rebuilds the DnD model from it on a hit.
+            parsed = getattr(generation, "message", None) and generation.message.additional_kwargs.get("parsed")
+            if isinstance(parsed, BaseModel):
+                generation = generation.model_copy(deep=True)
+                generation.message.additional_kwargs["parsed"] = parsed.model_dump()
+            generations.append(dumps(generation))
+        self.cache.set(self.cache.make_key(llm_string=llm_string, prompt=prompt), json.dumps(generations))
+
+    def clear(self, **kwargs: Any) -> None:
+        self.cache.clear()
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records the latency, token counts and cost of every chat model call in the graph, labelled with its node."""
+    def __init__(self, provider: str):
+        self.provider = provider
+        self._runs: dict[UUID, tuple[float, str, Optional[str]]] = {}
+
+    def on_chat_model_start(self, serialized: dict, messages: list, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        metadata = metadata or {}
+        self._runs[run_id] = (time.perf_counter(), metadata.get("ls_model_name", ""), metadata.get("langgraph_node"))
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        if run_id not in self._runs:
+            return
+        start, model, node = self._runs.pop(run_id)
+        message = getattr(response.generations[0][0], "message", None) if response.generations and response.generations[0] else None
+        usage = getattr(message, "usage_metadata", None) or {}
+        metrics.record_llm_call(
+            self.provider,
+            model,
+            time.perf_counter() - start,
+            usage.get("input_tokens", 0),
+            usage.get("output_tokens", 0),
+            cached=bool(message is not None and message.response_metadata.get("from_cache")),
+            node=node,
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        if run_id in self._runs:
+            _, model, node = self._runs.pop(run_id)
+            metrics.inc("dnd_llm_errors_total", provider=self.provider, model=model, node=node)
+
+
 class dnd_converter:
-    def __init__(self):
+    # Reflection results of an earlier run on the same thread must not end this one early
+    INITIAL_REFLECTION_STATE = {"best_draft": None, "best_score": None, "stop_reason": None, "revisions_saved": 0}
+    # Structured output schemas of each model route: classification, critique and stat block generation
+    ROUTE_SCHEMAS = {
+        "classify": (DnDType,),
+        "critique": (ReflectionVerdict,),
+        "generate": (DnDTypedObject, *DND_MAP.values()),
+    }
 
-        # Initialize the model
-        if use_local_llm:
-            self.model = ChatOllama(model=ollama_llm, temperature=0)
-        else:
-            self.model = ChatOpenAI(model=openai_llm, temperature=0)
+    def __init__(self, use_cache: bool = True, fused: bool = fused_classify_generate, speculative: bool = speculative_retrieval):
+
+        # Initialize the model, sharing the LLM response cache unless it is bypassed
+        # Only the configured provider's integration is imported, the graph libraries are loaded when a converter is built
+        cache = LangChainLLMCache(llm_cache) if use_cache and llm_cache.enabled else False
+        from providers import create_chat_model, route_models
+        # Each route runs on its configured model, falling back to the next one if a call fails.
+        # Routes using the same model share one chat model, and with it its HTTP client
+        self.chat_models = {}
+        self.route_models = {route: route_models(route) for route in self.ROUTE_SCHEMAS}
+        for provider, model in {provider_model for models in self.route_models.values() for provider_model in models}:
+            self.chat_models[(provider, model)] = create_chat_model(
+                provider, model=model, cache=cache, callbacks=[MetricsCallbackHandler(provider)]
+            )
+        self.model = self.chat_models[self.route_models["generate"][0]]
+        # Structured output runnables are built once per route and schema, instead of in every node run
+        self.structured_models = {
+            route: {schema: self._structured_model(route, schema) for schema in schemas}
+            for route, schemas in self.ROUTE_SCHEMAS.items()
+        }
+        from langgraph.graph import END, START, StateGraph
+        from checkpointer import create_checkpointer
 
         # Define the prompts
         self.TYPE_PROMPT_TEMPLATE = TYPE_PROMPT_TEMPLATE
         self.OBJECT_TEMPLATE = OBJECT_TEMPLATE
+        self.TYPED_OBJECT_TEMPLATE = TYPED_OBJECT_TEMPLATE
         self.SIMILAR_OBJECTS_TEMPLATE = SIMILAR_OBJECTS_TEMPLATE
         self.REFLECTION_PROMPT = REFLECTION_PROMPT
         self.REFLECT_OBJECT_TEMPLATE = REFLECT_OBJECT_TEMPLATE
@@ -50,12 +156,35 @@ class dnd_converter:
         # Create the graph
         # Nodes
         builder = StateGraph(AgentState)
-        builder.add_node("type_identifier", self.type_identifier_node)
-        builder.add_node("find_similar_objects", self.find_similar_objects)
-        builder.add_node("initial_generate", self.initial_generation_node)
-        builder.add_node("reflect", self.reflection_node)
-        builder.add_node("reflection_generate", self.reflection_generation_node)
-        builder.set_entry_point("type_identifier")
+
+        def add_node(name, node):
+            # Every node records its wall-clock time
+            builder.add_node(name, timed_node(name, node))
+
+        if fused:
+            # One structured call classifies and generates, so there is no separate type_identifier node.
+            # The type is not known before generation, so examples are retrieved for every type.
+            add_node("find_similar_objects", self.find_similar_objects_all_types)
+            add_node("initial_generate", self.typed_generation_node)
+            builder.set_entry_point("find_similar_objects")
+        elif speculative:
+            # Fan out: classify and retrieve examples for every likely type at the same time,
+            # then fan in once both are done, keeping only the examples of the classified type
+            add_node("type_identifier", self.type_identifier_node)
+            add_node("speculative_retrieve", self.speculative_retrieval_node)
+            add_node("find_similar_objects", self.select_similar_objects)
+            add_node("initial_generate", self.initial_generation_node)
+            builder.add_edge(START, "type_identifier")
+            builder.add_edge(START, "speculative_retrieve")
+            builder.add_edge(["type_identifier", "speculative_retrieve"], "find_similar_objects")
+        else:
+            add_node("type_identifier", self.type_identifier_node)
+            add_node("find_similar_objects", self.find_similar_objects)
+            add_node("initial_generate", self.initial_generation_node)
+            builder.set_entry_point("type_identifier")
+            builder.add_edge("type_identifier", "find_similar_objects")
+        add_node("reflect", self.reflection_node)
+        add_node("reflection_generate", self.reflection_generation_node)
         # Edges
         builder.add_conditional_edges(
             "initial_generate", self.should_continue, {END: END, "reflect": "reflect"}
@@ -63,23 +192,38 @@ class dnd_converter:
         builder.add_conditional_edges(
             "reflection_generate", self.should_continue, {END: END, "reflect": "reflect"}
         )
-        builder.add_edge("type_identifier", "find_similar_objects")
+        builder.add_conditional_edges(
+            "reflect", self.should_revise, {END: END, "reflection_generate": "reflection_generate"}
+        )
         builder.add_edge("find_similar_objects", "initial_generate")
-        builder.add_edge("reflect", "reflection_generate")
 
-        # Compile graph with memory and interrupt states
-        checkpointer = MemorySaver()
+        # Compile graph with the configured checkpointer and interrupt states
+        self.checkpointer = create_checkpointer()
         self.graph = builder.compile(
-            checkpointer=checkpointer,
+            checkpointer=self.checkpointer,
             # interrupt_after=[],
         )
 
+    def _structured_model(self, route: str, schema: type[BaseModel]):
+        from resilience import resilient_runnable
+        # Each model has its own deadline, retries and rate limit, the fallback is only used once they are exhausted
+        primary, *fallbacks = [
+            resilient_runnable(self.chat_models[provider_model].with_structured_output(schema), *provider_model)
+            for provider_model in self.route_models[route]
+        ]
+        return primary.with_fallbacks(fallbacks) if fallbacks else primary
+
+    def invoke_route(self, route: str, schema: type[BaseModel], messages: list):
+        """Invoke the structured model of a route, recording the route's latency."""
+        with metrics.timer("dnd_route_seconds", route=route):
+            return self.structured_models[route][schema].invoke(messages)
+
     # Node definitions
     def type_identifier_node(self, state: AgentState):
         messages = [
             SystemMessage(content=self.TYPE_PROMPT_TEMPLATE.format(description=state["description"], system=state["dnd_system"])),
         ]
-        response = self.model.with_structured_output(DnDType).invoke(messages)
+        response = self.invoke_route("classify", DnDType, messages)
         return {
             "dnd_type": response.type,
             "lnode": "type_identifier",
@@ -87,14 +231,77 @@ class dnd_converter:
         }
 
     def find_similar_objects(self, state: AgentState):
-        query = f"Find a {state["dnd_type"]} similar to this description: {state["description"]}"
-        similar_objects = retrieve_similar_objects(query = query, dnd_type=state["dnd_type"])
+        # Retrieval loads the embedding model and vector index, so it is only imported by graphs that get this far
+        from rag_tools import retrieve_similar_objects
+        query = similar_objects_query(state["dnd_type"], state["description"])
+        similar_objects = retrieve_similar_objects(query = query, dnd_type=state["dnd_type"], filter=retrieval_filter(state))
         return {
-            "similar_objects": similar_objects,
+            # No examples, e.g. none of the target system, is the same as no documents
+            "similar_objects": similar_objects or None,
             "lnode": "find_similar_objects",
             "count": 1,
         }
     
+    def speculative_retrieval_node(self, state: AgentState):
+        # Runs alongside type_identifier, so it must not write lnode, which that node sets in the same step
+        from rag_tools import retrieve_similar_objects_by_type
+        dnd_types = speculative_retrieval_types or list(DND_MAP)
+        queries = {dnd_type: similar_objects_query(dnd_type, state["description"]) for dnd_type in dnd_types}
+        return {
+            "speculative_objects": retrieve_similar_objects_by_type(queries, filter=retrieval_filter(state)),
+            "count": 1,
+        }
+
+    def select_similar_objects(self, state: AgentState):
+        speculative_objects = state.get("speculative_objects") or {}
+        if state["dnd_type"] not in speculative_objects:
+            # The type was not retrieved speculatively, or has no documents yet
+            return self.find_similar_objects(state) | {"speculative_objects": None}
+        return {
+            "similar_objects": speculative_objects[state["dnd_type"]] or None,
+            # Discard the examples retrieved for the other types
+            "speculative_objects": None,
+            "lnode": "find_similar_objects",
+            "count": 1,
+        }
+
+    def find_similar_objects_all_types(self, state: AgentState):
+        from rag_tools import retrieve_similar_objects_by_type
+        query = f"Find an object similar to this description: {state["description"]}"
+        similar_objects = retrieve_similar_objects_by_type(query=query, filter=retrieval_filter(state))
+        return {
+            "similar_objects": similar_objects or None,
+            "lnode": "find_similar_objects",
+            "count": 1,
+        }
+
+    def typed_generation_node(self, state: AgentState):
+        messages = [
+            SystemMessage(content=self.TYPED_OBJECT_TEMPLATE.format(description=state["description"], system=state["dnd_system"]))
+        ]
+        similar_objects_by_type = {dnd_type: objects for dnd_type, objects in (state["similar_objects"] or {}).items() if objects}
+        tokens_saved = 0
+        for dnd_type, similar_objects in similar_objects_by_type.items():
+            # The examples of every type share the prompt's budget
+            similar_objects, saved = examples_prompt(
+                similar_objects, "similar_objects", prompt_examples_token_budget // len(similar_objects_by_type)
+            )
+            tokens_saved += saved
+            messages.append(SystemMessage(content=self.SIMILAR_OBJECTS_TEMPLATE.format(
+            dnd_type=dnd_type, similar_objects=similar_objects
+        )))
+        response = self.invoke_route("generate", DnDTypedObject, messages)
+        dnd_type, draft = response.split()
+        return {
+            "dnd_type": dnd_type,
+            "draft": draft,
+            "revision_number": state.get("revision_number", 1) + 1,
+            "lnode": "initial_generate",
+            "count": 1,
+            "prompt_tokens_saved": tokens_saved,
+            **self.INITIAL_REFLECTION_STATE,
+        }
+
     def initial_generation_node(self, state: AgentState):
         dnd_class = DND_MAP[state["dnd_type"]]
         messages = [
@@ -102,63 +309,141 @@ class dnd_converter:
             dnd_type=state["dnd_type"], description=state["description"], system=state["dnd_system"]
         ))
         ]
+        tokens_saved = 0
         if state["similar_objects"] is not None:
+            similar_objects, tokens_saved = examples_prompt(state["similar_objects"], "similar_objects")
             messages.append(SystemMessage(content=self.SIMILAR_OBJECTS_TEMPLATE.format(
-            dnd_type=state["dnd_type"], similar_objects=state["similar_objects"]
+            dnd_type=state["dnd_type"], similar_objects=similar_objects
         )))
-        response = self.model.with_structured_output(dnd_class).invoke(messages)
+        response = self.invoke_route("generate", dnd_class, messages)
         return {
             "draft": response,
             "revision_number": state.get("revision_number", 1) + 1,
             "lnode": "initial_generate",
             "count": 1,
+            "prompt_tokens_saved": tokens_saved,
+            **self.INITIAL_REFLECTION_STATE,
         }
 
     def reflection_node(self, state: AgentState):
+        stat_block, tokens_saved = stat_block_prompt(state["draft"], "reflection")
         messages = [
             SystemMessage(content=self.REFLECTION_PROMPT.format(
                 dnd_type=state["dnd_type"],
                 description=state["description"],
                 system=state["dnd_system"],
-                object_stat_block=state["draft"],
+                object_stat_block=stat_block,
             )),
         ]
-        response = self.model.invoke(messages)
-        return {
-            "critique": response.content,
+        response = self.invoke_route("critique", ReflectionVerdict, messages)
+        update = {
+            "critique": response.critique,
+            "score": response.score,
             "lnode": "reflect",
             "count": 1,
+            "prompt_tokens_saved": tokens_saved,
         }
 
+        # Keep the best scored draft, so a revision that made it worse can be discarded
+        best_score = state.get("best_score")
+        if best_score is None or response.score > best_score:
+            update["best_draft"] = state["draft"]
+            update["best_score"] = response.score
+        if response.verdict == "accept":
+            update["stop_reason"] = "accepted"
+        elif best_score is not None and response.score <= best_score:
+            update["stop_reason"] = "no_improvement"
+            update["draft"] = state["best_draft"]
+        if "stop_reason" in update:
+            # Every revision left is skipped, each one a regeneration and usually a reflection
+            update["revisions_saved"] = max(state["max_revisions"] - state["revision_number"] + 1, 0)
+        return update
+
     def reflection_generation_node(self, state: AgentState):
         dnd_class = DND_MAP[state["dnd_type"]]
+        stat_block, tokens_saved = stat_block_prompt(state["draft"], "reflection_generate")
         messages = [
             SystemMessage(content=self.REFLECT_OBJECT_TEMPLATE.format(
-            dnd_type=state["dnd_type"], description=state["description"], system=state["dnd_system"], object_stat_block=state["draft"], critique=state["critique"]
+            dnd_type=state["dnd_type"], description=state["description"], system=state["dnd_system"], object_stat_block=stat_block, critique=state["critique"]
         )),
         ]
-        response = self.model.with_structured_output(dnd_class).invoke(messages)
+        response = self.invoke_route("generate", dnd_class, messages)
         return {
             "draft": response,
             "revision_number": state.get("revision_number", 1) + 1,
             "lnode": "reflection_generate",
             "count": 1,
+            "prompt_tokens_saved": tokens_saved,
         }
 
     # Conditional edge definition
     def should_continue(self, state):
+        from langgraph.graph import END
         if state["revision_number"] > state["max_revisions"]:
             return END
         return "reflect"
 
+    def should_revise(self, state):
+        """End as soon as the reflection accepts the draft or the score stops improving."""
+        from langgraph.graph import END
+        if state.get("stop_reason"):
+            return END
+        return "reflection_generate"
+
+    def stream(self, inputs: Optional[dict], thread: dict) -> Iterator[tuple[str, str, Any]]:
+        """
+        Run the graph, yielding events as they happen instead of waiting for the final state:
+            ("token", node, text)   a chunk of model output from the running node, partial JSON for stat blocks
+            ("node", node, update)  the state update of a node that has finished
+        The final state is available from self.graph.get_state(thread) once the stream is exhausted.
+        """
+        for mode, payload in self.graph.stream(inputs, thread, stream_mode=["messages", "updates"]):
+            if mode == "messages":
+                chunk, metadata = payload
+                text = chunk.content if isinstance(chunk.content, str) else ""
+                # Structured outputs using tool calls stream their JSON as tool call arguments
+                text += "".join(tool_call.get("args") or "" for tool_call in getattr(chunk, "tool_call_chunks", []))
+                if text:
+                    yield "token", metadata.get("langgraph_node"), text
+            else:
+                for node, update in payload.items():
+                    yield "node", node, update
+
+    def mark_completed(self, thread: dict):
+        """Let the checkpointer expire a finished thread's checkpoints, if it supports retention."""
+        if hasattr(self.checkpointer, "mark_completed"):
+            self.checkpointer.mark_completed(thread["configurable"]["thread_id"])
+
+# Converters shared by the whole process, keyed by their options
+_converters: dict[tuple, dnd_converter] = {}
+_converters_lock = threading.Lock()
+
+def get_converter(use_cache: bool = True, fused: bool = fused_classify_generate, speculative: bool = speculative_retrieval) -> dnd_converter:
+    """
+    The long-lived converter for a set of options, created on first use.
+    Its chat model, HTTP connection pool, structured output runnables and compiled graph are reused by every run,
+    which can run concurrently on different thread ids.
+    """
+    key = (use_cache, fused, speculative)
+    with _converters_lock:
+        if key not in _converters:
+            _converters[key] = dnd_converter(use_cache=use_cache, fused=fused, speculative=speculative)
+        return _converters[key]
+
+def similar_objects_query(dnd_type: str, description: str) -> str:
+    """The retrieval query for examples of a D&D type similar to a description."""
+    return f"Find a {dnd_type} similar to this description: {description}"
+
+def retrieval_filter(state: AgentState) -> Optional[dict]:
+    """Metadata filter for example retrieval, on top of the D&D type."""
+    return {"dnd_system": state["dnd_system"]} if retrieval_same_system_only else None
+
 def append_to_output_file(data):
-    """Append a row of data to the output CSV file"""
-    output_file = Path(f"{dnd_converter_outputs_name}_{data['dnd_type'].replace(' ', '_').lower()}.csv")
-    df = pd.DataFrame([data])
-    if not output_file.exists():
-        df.to_csv(output_file, mode='a', index=False)
-    else:
-        df.to_csv(output_file, mode='a', header=False, index=False)
+    """
+    Append a row of data to the output store.
+    Rows are buffered and written in batches, each new row is embedded once for retrieval when its batch is written.
+    """
+    get_output_store().append(data)
 
 def save_result_to_file(result):
     """Save the result to the output file"""
@@ -171,37 +456,39 @@ def save_result_to_file(result):
     # Append the result to the output file
     append_to_output_file(data)
 
-def main():
+def main(stream: bool = True):
     """Function to process a single description using the agent"""
     description = "A ritual made by arranging red dragon bones in a circle."
     max_revisions = 1
-    thread = {"configurable": {"thread_id": "1"}}
-
-    # # To get all the intermediate results
-    # for s in dnd_converter().graph.stream(
-    #     {
-    #         "description": description,
-    #         "dnd_system": "D&D 5e",
-    #         "max_revisions": max_revisions,
-    #         "revision_number": 0,
-    #     },
-    #     thread,
-    # ):
-    #     print(s)
-    
-    # To get just the final result
-    result = dnd_converter().graph.invoke(
-        {
-            "description": description,
-            "dnd_system": "D&D 5e",
-            "max_revisions": max_revisions,
-            "revision_number": 0,
-        },
-        thread,
-    )
+    # Checkpoints can outlive the process, so every run gets its own thread
+    thread = {"configurable": {"thread_id": str(uuid.uuid4())}}
+    inputs = {
+        "description": description,
+        "dnd_system": "D&D 5e",
+        "max_revisions": max_revisions,
+        "revision_number": 0,
+    }
+
+    converter = get_converter()
+    if stream:
+        # Print model output as it is generated, and each node as it finishes
+        for event, node, payload in converter.stream(inputs, thread):
+            if event == "token":
+                print(payload, end="", flush=True)
+            else:
+                print(f"\n[{node} finished]", flush=True)
+        result = converter.graph.get_state(thread).values
+    else:
+        # To get just the final result
+        result = converter.graph.invoke(inputs, thread)
 
     # Save the final result to the output file
     save_result_to_file(result)
+    get_output_store().flush()
+    converter.mark_completed(thread)
+
+    if result.get("stop_reason"):
+        print(f"Stopped revising ({result['stop_reason']}), {result['revisions_saved']} revisions saved")
 
     # Return the final result
     print(result["draft"].model_dump())
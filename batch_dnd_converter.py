@@ -0,0 +1,252 @@
+import argparse
+import csv
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterator
+from agent_dnd_converter import dnd_converter, get_converter, save_result_to_file
+from output_store import get_output_store
+from metrics import metrics
+from config import metrics_host
+from semantic_cache import semantic_cache
+
+# The output store and the progress file are shared by every worker
+_write_lock = threading.RLock()
+
+def read_inputs(input_path: Path, dnd_system: str = "D&D 5e", max_revisions: int = 1) -> Iterator[dict]:
+    """
+    Streams descriptions from a JSONL or CSV file, one at a time.
+    Each record needs a "description", and can set its own "id", "dnd_system" and "max_revisions".
+    Records without an id get one derived from their description and system, so it is stable across runs.
+    Malformed records are reported and skipped, so one bad line does not abort the batch.
+    """
+    is_csv = input_path.suffix.lower() == ".csv"
+    with open(input_path, encoding="utf-8", newline="") as f:
+        for number, record in enumerate(csv.DictReader(f) if is_csv else f, start=1):
+            try:
+                if not is_csv:
+                    if not record.strip():
+                        continue
+                    record = json.loads(record)
+                item = _input_item(record, dnd_system, max_revisions)
+            except (ValueError, TypeError) as e:
+                print(f"Skipping {'row' if is_csv else 'line'} {number} of {input_path}: {e}")
+                continue
+            yield item
+
+def _input_item(record: object, dnd_system: str, max_revisions: int) -> dict:
+    if not isinstance(record, dict):
+        raise TypeError("record must be a JSON object")
+    description = record.get("description")
+    if not isinstance(description, str) or not description.strip():
+        raise ValueError("description must be a non-empty string")
+    item = {
+        "description": description,
+        "dnd_system": record.get("dnd_system") or dnd_system,
+        "max_revisions": int(record.get("max_revisions") or max_revisions),
+    }
+    item["id"] = str(record.get("id") or hashlib.sha256(
+        f"{item['dnd_system']}\n{item['description']}".encode("utf-8")
+    ).hexdigest()[:16])
+    return item
+
+def load_finished_ids(progress_path: Path) -> set[str]:
+    """Ids of the inputs already converted by a previous run, read from the progress file."""
+    if not progress_path.exists():
+        return set()
+    with open(progress_path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {record["id"] for record in records if record["status"] == "done"}
+
+def _record_progress(progress_path: Path, record: dict):
+    with open(progress_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+class ProgressRecorder:
+    """
+    Records finished inputs in the progress file, but only once their results have been flushed by the output store.
+    Otherwise a crash could lose a buffered result whose input is already marked as done.
+    """
+    def __init__(self, progress_path: Path):
+        self.progress_path = progress_path
+        self.pending: list[dict] = []
+
+    def add(self, record: dict):
+        with _write_lock:
+            self.pending.append(record)
+
+    def write_pending(self, rows: list[dict] | None = None):
+        """Output store flush listener, every pending record's row was appended before the flush."""
+        with _write_lock:
+            for record in self.pending:
+                _record_progress(self.progress_path, record)
+            self.pending = []
+
+def convert_item(converter: dnd_converter, item: dict, progress: ProgressRecorder, use_semantic_cache: bool = True) -> tuple[float, int, bool]:
+    """
+    Runs the agent graph for one input on its own thread id, or answers it from the semantic cache, saves a new result
+    and returns the latency in seconds, the number of revisions saved by ending the reflection loop early
+    and whether the semantic cache answered it.
+    With a durable checkpointer, a run interrupted by a crash resumes from its last completed node.
+    """
+    start = time.perf_counter()
+    thread = {"configurable": {"thread_id": f"batch-{item['id']}"}}
+    snapshot = converter.graph.get_state(thread)
+    cached = None
+    if not snapshot.next and snapshot.values.get("draft") is None and use_semantic_cache:
+        cached = semantic_cache.lookup(item["description"], item["dnd_system"])
+    if cached is not None:
+        result = cached
+    elif snapshot.next:
+        print(f"Resuming {item['id']} after {snapshot.values.get('lnode')}...")
+        result = converter.graph.invoke(None, thread)
+    elif snapshot.values.get("draft") is not None:
+        # The run finished before the crash, only saving its result was lost
+        result = snapshot.values
+    else:
+        result = converter.graph.invoke(
+            {
+                "description": item["description"],
+                "dnd_system": item["dnd_system"],
+                "max_revisions": item["max_revisions"],
+                "revision_number": 0,
+            },
+            thread,
+        )
+    latency = time.perf_counter() - start
+    revisions_saved = result.get("revisions_saved") or 0
+    with _write_lock:
+        # A semantic cache hit is already a stored row, saving it again would duplicate it
+        if cached is None:
+            save_result_to_file(result)
+        progress.add({
+            "id": item["id"], "status": "done", "seconds": latency, "revisions_saved": revisions_saved, "semantic_cache": cached is not None,
+            "prompt_tokens_saved": result.get("prompt_tokens_saved") or 0,
+        })
+    converter.mark_completed(thread)
+    return latency, revisions_saved, cached is not None
+
+def _percentile(sorted_values: list[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(percentile / 100 * (len(sorted_values) - 1))))]
+
+def run_batch(
+    input_path: str | Path,
+    workers: int = 4,
+    dnd_system: str = "D&D 5e",
+    max_revisions: int = 1,
+    progress_path: str | Path | None = None,
+    use_semantic_cache: bool = True,
+) -> dict:
+    """
+    Converts every description in an input file with the agent graph, running up to `workers` graph invocations concurrently.
+    Finished inputs are recorded in a progress file next to the input, so an interrupted batch skips them when rerun.
+
+    Args:
+        input_path (str | Path): JSONL or CSV file of descriptions.
+        workers (int): Number of concurrent graph invocations. Defaults to 4.
+        dnd_system (str): Target system for records that do not set one. Defaults to "D&D 5e".
+        max_revisions (int): Revisions for records that do not set one. Defaults to 1.
+        progress_path (str | Path | None): Progress file. Defaults to <input_path>.progress.jsonl.
+        use_semantic_cache (bool): Answer near-duplicates of converted descriptions from the semantic cache. Defaults to True.
+
+    Returns:
+        dict: Counts of converted, skipped and failed inputs, throughput in items/sec, p50/p95 latency in seconds,
+            the revisions saved by ending reflection early and the inputs answered by the semantic cache.
+    """
+    input_path = Path(input_path)
+    progress_path = Path(progress_path) if progress_path else input_path.with_name(input_path.name + ".progress.jsonl")
+    finished = load_finished_ids(progress_path)
+    converter = get_converter()
+    progress = ProgressRecorder(progress_path)
+    output_store = get_output_store()
+    output_store.add_flush_listener(progress.write_pending)
+
+    latencies, skipped, failed, revisions_saved, semantic_cache_hits = [], 0, 0, 0, 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+
+        def collect(done):
+            nonlocal failed, revisions_saved, semantic_cache_hits
+            for future in done:
+                item = in_flight.pop(future)
+                try:
+                    latency, saved, cached = future.result()
+                    latencies.append(latency)
+                    revisions_saved += saved
+                    semantic_cache_hits += cached
+                except Exception as e:
+                    failed += 1
+                    print(f"Error converting {item['id']}: {e}")
+                    with _write_lock:
+                        _record_progress(progress_path, {"id": item["id"], "status": "error", "error": str(e)})
+            completed = len(latencies) + failed
+            if done and completed % 10 == 0:
+                print(f"Converted {completed} items, {completed / (time.perf_counter() - start):.2f} items/sec")
+
+        for item in read_inputs(input_path, dnd_system=dnd_system, max_revisions=max_revisions):
+            if item["id"] in finished:
+                skipped += 1
+                continue
+            finished.add(item["id"])
+            # Keep a bounded number of inputs queued, so large input files are streamed rather than loaded
+            while len(in_flight) >= 2 * workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[executor.submit(convert_item, converter, item, progress, use_semantic_cache)] = item
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    # Write the last results, after which every finished input can be recorded
+    output_store.flush()
+    progress.write_pending()
+    output_store.remove_flush_listener(progress.write_pending)
+
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    stats = {
+        "converted": len(latencies),
+        "skipped": skipped,
+        "failed": failed,
+        "seconds": elapsed,
+        "items_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_latency": _percentile(latencies, 50),
+        "p95_latency": _percentile(latencies, 95),
+        "revisions_saved": revisions_saved,
+        "semantic_cache_hits": semantic_cache_hits,
+    }
+    print(json.dumps(stats, indent=2))
+    metrics.write_prometheus()
+    return stats
+
+def main():
+    """Batch convert descriptions from a JSONL or CSV file"""
+    parser = argparse.ArgumentParser(description="Convert many descriptions with the agent D&D converter.")
+    parser.add_argument("input_path", help="JSONL or CSV file with a description per record")
+    parser.add_argument("--workers", type=int, default=4, help="Number of concurrent graph invocations")
+    parser.add_argument("--system", default="D&D 5e", help="Target system for records that do not set one")
+    parser.add_argument("--max-revisions", type=int, default=1, help="Revisions for records that do not set one")
+    parser.add_argument("--progress", default=None, help="Progress file, defaults to <input_path>.progress.jsonl")
+    parser.add_argument("--no-semantic-cache", action="store_true", help="Run the graph even for near-duplicates of converted descriptions")
+    parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this port while the batch runs")
+    parser.add_argument("--metrics-host", default=metrics_host, help="Interface the metrics are served on")
+    args = parser.parse_args()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    run_batch(
+        args.input_path,
+        workers=args.workers,
+        dnd_system=args.system,
+        max_revisions=args.max_revisions,
+        progress_path=args.progress,
+        use_semantic_cache=not args.no_semantic_cache,
+    )
+
+if __name__ == "__main__":
+    main()
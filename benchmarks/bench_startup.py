@@ -0,0 +1,75 @@
+"""
+Startup benchmark: measures how long each entry point takes to import, in a fresh interpreter per run.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 5] [--modules orchestrator dnd_converter ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+ENTRY_POINTS = ["orchestrator", "dnd_converter", "agent_dnd_converter", "batch_dnd_converter"]
+
+# Prints the import time of one module, measured inside the child interpreter so interpreter startup is excluded
+IMPORT_SNIPPET = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+def time_import(module: str) -> float:
+    """Import a module in a fresh interpreter and return the import time in seconds."""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET.format(module=module)],
+        cwd=REPO_ROOT,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+def heaviest_imports(module: str, top: int = 5) -> list[tuple[str, float]]:
+    """The top-level packages with the largest cumulative import time when importing a module, from python -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        package = name.strip().split(".")[0]
+        if cumulative.strip().isdigit() and package != module:
+            times[package] = max(times.get(package, 0.0), int(cumulative) / 1e6)
+    return sorted(times.items(), key=lambda item: item[1], reverse=True)[:top]
+
+def run(modules: list[str], runs: int) -> dict:
+    """Time each module's import over several runs, returning min, median and max in seconds per module."""
+    results = {}
+    for module in modules:
+        times = [time_import(module) for _ in range(runs)]
+        results[module] = {"min": min(times), "median": statistics.median(times), "max": max(times)}
+        print(f"{module:<24} median {results[module]['median']:.3f}s  min {results[module]['min']:.3f}s  max {results[module]['max']:.3f}s")
+        for name, seconds in heaviest_imports(module):
+            print(f"    {name:<30} {seconds:.3f}s")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of each entry point.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per entry point")
+    parser.add_argument("--modules", nargs="+", default=ENTRY_POINTS, help="Modules to import")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+    results = run(args.modules, args.runs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Offline benchmark suite, running on the deterministic fake LLM and embedding providers so no API is called.
+Every run is appended to a results file and compared with the median of the previous runs, flagging regressions.
+
+Usage:
+    python benchmarks/bench_suite.py [--quick] [--only graph retrieval parse output] [--llm-latency 0.0] [--fail-on-regression]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+RESULTS_PATH = Path(__file__).resolve().parent / "results.jsonl"
+sys.path.insert(0, str(REPO_ROOT))
+
+BENCHMARKS = ["graph", "retrieval", "embedding", "parse", "output"]
+
+def configure_offline(llm_latency: float, embedding_latency: float):
+    """Point every provider at the fakes and every store at a scratch directory. Must run before the repo modules are imported."""
+    import config
+    config.llm_provider = "fake"
+    config.embedding_provider = "fake"
+    config.fake_llm_latency_seconds = llm_latency
+    config.fake_embedding_latency_seconds = embedding_latency
+    config.llm_cache_enabled = False
+    # Benchmark inputs are near-duplicates of each other, so the semantic cache would answer most graph runs
+    config.semantic_cache_enabled = False
+    config.metrics_prometheus_path = None
+    os.chdir(tempfile.mkdtemp(prefix="dnd_bench_"))
+
+def _result(value: float, unit: str, higher_is_better: bool) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+def _fake_rows(dnd_type: str, count: int, offset: int = 0) -> list[dict]:
+    from dnd_classes import DND_MAP
+    from providers import fake_structured_output
+    rows = []
+    for i in range(offset, offset + count):
+        description = f"{dnd_type} example {i}"
+        row = {"description": description, "dnd_type": dnd_type, "dnd_system": "D&D 5e"}
+        row.update(fake_structured_output(DND_MAP[dnd_type], description).model_dump())
+        rows.append(row)
+    return rows
+
+def bench_graph(items: int, workers: int, seed_rows: int) -> dict:
+    """End-to-end agent graph throughput with the batch runner: checkpointing, retrieval, generation, reflection and output writes."""
+    from batch_dnd_converter import run_batch
+    from dnd_classes import DND_MAP
+    from output_store import get_output_store
+
+    output_store = get_output_store()
+    for dnd_type in DND_MAP:
+        for row in _fake_rows(dnd_type, seed_rows):
+            output_store.append(row)
+    output_store.flush()
+
+    input_path = Path("graph_inputs.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i in range(items):
+            f.write(json.dumps({"description": f"A glowing relic number {i} that hums with arcane power."}) + "\n")
+    stats = run_batch(input_path, workers=workers)
+    return {
+        "graph_items_per_sec": _result(stats["items_per_sec"], "items/s", True),
+        "graph_p95_latency": _result(stats["p95_latency"], "s", False),
+    }
+
+def bench_retrieval(rows: int, dim: int, queries: int, k: int = 10) -> dict:
+    """
+    Query latency of the vector index in exact and approximate mode, unfiltered and filtered to one of five D&D types,
+    and the recall of approximate search.
+    """
+    from dnd_classes import DND_MAP
+    from vector_index import VectorIndex
+
+    # Embeddings of stat blocks cluster by topic, so the rows are drawn around a set of topic centres
+    rng = np.random.default_rng(0)
+    centres = rng.standard_normal((256, dim), dtype=np.float32)
+
+    def sample(count: int) -> np.ndarray:
+        return centres[rng.integers(len(centres), size=count)] + 0.5 * rng.standard_normal((count, dim), dtype=np.float32)
+
+    dnd_types = list(DND_MAP)
+    index = VectorIndex(Path(f"retrieval_{rows}"), model=f"fake-{dim}", mode="exact")
+    start = time.perf_counter()
+    for block_start in range(0, rows, 100_000):
+        block_rows = min(100_000, rows - block_start)
+        index.add(
+            [str(i) for i in range(block_start, block_start + block_rows)],
+            sample(block_rows),
+            [{"dnd_type": dnd_types[i % len(dnd_types)]} for i in range(block_start, block_start + block_rows)],
+        )
+    add_seconds = time.perf_counter() - start
+    query_vectors = sample(queries)
+
+    def timed_search(mode: str, filter: dict | None = None) -> tuple[list[float], list]:
+        index.mode = mode
+        latencies, results = [], []
+        for query in query_vectors:
+            query_start = time.perf_counter()
+            results.append({text_hash for text_hash, _ in index.search(query, k=k, filter=filter)})
+            latencies.append(time.perf_counter() - query_start)
+        return latencies, results
+
+    exact_latencies, exact_results = timed_search("exact")
+    filtered_exact_latencies, filtered_exact_results = timed_search("exact", {"dnd_type": "Spell"})
+    start = time.perf_counter()
+    index.train()
+    train_seconds = time.perf_counter() - start
+    approximate_latencies, approximate_results = timed_search("approximate")
+    filtered_approximate_latencies, filtered_approximate_results = timed_search("approximate", {"dnd_type": "Spell"})
+    recall = statistics.mean(len(a & e) / len(e) for a, e in zip(approximate_results, exact_results))
+    filtered_recall = statistics.mean(len(a & e) / len(e) for a, e in zip(filtered_approximate_results, filtered_exact_results))
+    return {
+        f"retrieval_{rows}_filtered_exact_p50": _result(statistics.median(filtered_exact_latencies), "s", False),
+        f"retrieval_{rows}_filtered_approximate_p50": _result(statistics.median(filtered_approximate_latencies), "s", False),
+        f"retrieval_{rows}_filtered_approximate_recall": _result(filtered_recall, f"recall@{k}", True),
+        f"retrieval_{rows}_add_rows_per_sec": _result(rows / add_seconds, "rows/s", True),
+        f"retrieval_{rows}_exact_p50": _result(statistics.median(exact_latencies), "s", False),
+        f"retrieval_{rows}_approximate_p50": _result(statistics.median(approximate_latencies), "s", False),
+        f"retrieval_{rows}_approximate_recall": _result(recall, f"recall@{k}", True),
+        f"retrieval_{rows}_train_seconds": _result(train_seconds, "s", False),
+    }
+
+def bench_embedding(texts: int, duplicate_fraction: float = 0.5) -> dict:
+    """Embedding throughput through the deduplicating, batching cache, cold and warm, and the latency of a cached query."""
+    from embedding_cache import EmbeddingCache
+    from providers import CachedEmbeddings, FakeEmbeddings
+
+    base = FakeEmbeddings()
+    embeddings = CachedEmbeddings(base, model=base.model, batch_size=1000, cache=EmbeddingCache(path="bench_embeddings.sqlite"))
+    distinct = int(texts * (1 - duplicate_fraction))
+    data = [f"A stat block about relic {i % distinct} and its arcane powers" for i in range(texts)]
+    results = {}
+    for name in ("cold", "warm"):
+        start = time.perf_counter()
+        embeddings.embed_documents(data)
+        results[f"embedding_{name}_texts_per_sec"] = _result(texts / (time.perf_counter() - start), "texts/s", True)
+    start = time.perf_counter()
+    for text in data[:100]:
+        embeddings.embed_query(text)
+    results["embedding_cached_query_latency"] = _result((time.perf_counter() - start) / 100, "s", False)
+    return results
+
+def bench_parse(k: int, repeats: int = 20) -> dict:
+    """Turning k retrieved documents into stat block objects, from their stored rows and by parsing their text."""
+    from dnd_classes import DnDSpell
+    from output_store import to_csv_value
+    from rag_tools import parse_dnd_objects, to_dnd_object
+
+    rows = _fake_rows("Spell", k)
+    text = "\n--document-separator--\n".join(
+        "\n".join(f"{key}: {to_csv_value(value).strip()}" for key, value in row.items()) for row in rows
+    )
+
+    def best_of(function) -> float:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    return {
+        f"parse_text_{k}_docs": _result(best_of(lambda: parse_dnd_objects(text, DnDSpell)), "s", False),
+        f"parse_rows_{k}_docs": _result(best_of(lambda: [to_dnd_object(row, DnDSpell) for row in rows]), "s", False),
+    }
+
+def bench_output(rows: int) -> dict:
+    """Buffered output store writes, for the SQLite and CSV backends."""
+    from output_store import CSVOutputStore, SQLiteOutputStore
+
+    results = {}
+    for name, store in [("sqlite", SQLiteOutputStore(path="bench_outputs.sqlite")), ("csv", CSVOutputStore())]:
+        data = _fake_rows("Magic Item", rows)
+        start = time.perf_counter()
+        for row in data:
+            store.append(row)
+        store.flush()
+        results[f"output_{name}_rows_per_sec"] = _result(rows / (time.perf_counter() - start), "rows/s", True)
+    return results
+
+def load_history(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(results: dict, history: list[dict], threshold: float, window: int = 5) -> list[dict]:
+    """Compare each result with the median of its last `window` recorded values, flagging changes worse than threshold."""
+    comparisons = []
+    for name, result in results.items():
+        previous = [run["results"][name]["value"] for run in history if name in run.get("results", {})][-window:]
+        baseline = statistics.median(previous) if previous else None
+        change = (result["value"] - baseline) / baseline if baseline else None
+        regression = change is not None and (-change if result["higher_is_better"] else change) > threshold
+        comparisons.append({"name": name, **result, "baseline": baseline, "change": change, "regression": regression})
+    return comparisons
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite and flag regressions against earlier runs.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes, skipping the 1M row retrieval benchmark")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per fake LLM call")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Simulated seconds per fake embedding request")
+    parser.add_argument("--results", default=str(RESULTS_PATH), help="JSONL file the results are appended to and compared with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if any benchmark regressed")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the code under benchmark")
+    args = parser.parse_args()
+    results_path = Path(args.results).resolve()
+    configure_offline(args.llm_latency, args.embedding_latency)
+
+    results = {}
+    benchmarks = {
+        "graph": lambda: bench_graph(items=20 if args.quick else 100, workers=4, seed_rows=50 if args.quick else 200),
+        "retrieval": lambda: {
+            name: result
+            for rows in ([1_000, 100_000] if args.quick else [1_000, 100_000, 1_000_000])
+            for name, result in bench_retrieval(rows, dim=64, queries=50 if args.quick else 200).items()
+        },
+        "embedding": lambda: bench_embedding(texts=2_000 if args.quick else 20_000),
+        "parse": lambda: {name: result for k in [10, 200] for name, result in bench_parse(k).items()},
+        "output": lambda: bench_output(rows=1_000 if args.quick else 10_000),
+    }
+    for name in args.only:
+        print(f"Running {name} benchmark...", flush=True)
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            results.update(benchmarks[name]())
+
+    run_args = {"only": args.only, "quick": args.quick, "llm_latency": args.llm_latency, "embedding_latency": args.embedding_latency}
+    # Sizes and simulated latencies change the results, so only runs with the same settings are comparable
+    settings = ("quick", "llm_latency", "embedding_latency")
+    history = [
+        run for run in load_history(results_path)
+        if all(run.get("args", {}).get(setting) == run_args[setting] for setting in settings)
+    ]
+    comparisons = compare(results, history, args.threshold)
+    for comparison in comparisons:
+        change = f"{comparison['change']:+.1%}" if comparison["change"] is not None else "new"
+        flag = "  REGRESSION" if comparison["regression"] else ""
+        print(f"{comparison['name']:<40} {comparison['value']:>14.6g} {comparison['unit']:<10} {change:>8}{flag}")
+
+    run = {
+        "time": time.time(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "args": run_args,
+        "results": results,
+    }
+    with open(results_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+
+    if args.fail_on_regression and any(comparison["regression"] for comparison in comparisons):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
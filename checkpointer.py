@@ -0,0 +1,361 @@
+import random
+import sqlite3
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator, Sequence
+from pathlib import Path
+from typing import Any, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.types import TASKS
+from config import (
+    checkpointer_backend,
+    checkpoint_db_path,
+    checkpoint_keep_last,
+    checkpoint_completed_ttl_seconds,
+    checkpoint_prune_every,
+)
+
+class SQLiteCheckpointer(BaseCheckpointSaver[str]):
+    """
+    Durable LangGraph checkpointer, stored in a SQLite file so interrupted runs can resume after a restart.
+
+    Memory stays flat no matter how many threads are run, and the file is kept bounded by retention policies:
+        keep_last              only the last N checkpoints of each thread are kept
+        completed_ttl_seconds  threads marked completed with mark_completed are deleted once this old
+    Retention runs every prune_every checkpoints. compact() also prunes and then reclaims the freed disk space.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = checkpoint_db_path,
+        keep_last: int = checkpoint_keep_last,
+        completed_ttl_seconds: float = checkpoint_completed_ttl_seconds,
+        prune_every: int = checkpoint_prune_every,
+    ):
+        super().__init__()
+        self.path = Path(path)
+        self.keep_last = keep_last
+        self.completed_ttl_seconds = completed_ttl_seconds
+        self.prune_every = prune_every
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                checkpoint_type TEXT NOT NULL,
+                checkpoint BLOB NOT NULL,
+                metadata_type TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+            );
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                value_type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                task_path TEXT NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS threads (
+                thread_id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS threads_completed ON threads (completed, updated_at);
+            """
+        )
+        self._connection.commit()
+
+    # Reading checkpoints
+    def _pending_sends(self, thread_id: str, checkpoint_ns: str, parent_checkpoint_id: Optional[str]) -> Sequence[Any]:
+        if not parent_checkpoint_id:
+            return []
+        rows = self._connection.execute(
+            "SELECT value_type, value FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? AND channel = ? "
+            "ORDER BY task_path, task_id, idx",
+            (thread_id, checkpoint_ns, parent_checkpoint_id, TASKS),
+        ).fetchall()
+        return [self.serde.loads_typed((value_type, value)) for value_type, value in rows]
+
+    def _checkpoint_tuple(self, thread_id: str, checkpoint_ns: str, row: tuple) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata = row
+        writes = self._connection.execute(
+            "SELECT task_id, channel, value_type, value FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? "
+            "ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint={
+                **self.serde.loads_typed((checkpoint_type, checkpoint)),
+                "pending_sends": self._pending_sends(thread_id, checkpoint_ns, parent_checkpoint_id),
+            },
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id
+                else None
+            ),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed((value_type, value))) for task_id, channel, value_type, value in writes
+            ],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """Get the checkpoint with the config's checkpoint_id, or the latest checkpoint of its thread."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = (
+            "SELECT checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?"
+        )
+        params = [thread_id, checkpoint_ns]
+        if checkpoint_id := get_checkpoint_id(config):
+            query += " AND checkpoint_id = ?"
+            params.append(checkpoint_id)
+        query += " ORDER BY checkpoint_id DESC LIMIT 1"
+        with self._lock:
+            row = self._connection.execute(query, params).fetchone()
+            if row is None:
+                return None
+            return self._checkpoint_tuple(thread_id, checkpoint_ns, row)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        """List checkpoints, newest first, optionally restricted to a thread, a metadata filter or those before a checkpoint."""
+        query = (
+            "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints WHERE 1 = 1"
+        )
+        params = []
+        if config:
+            query += " AND thread_id = ?"
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                query += " AND checkpoint_ns = ?"
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                query += " AND checkpoint_id = ?"
+                params.append(checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            query += " AND checkpoint_id < ?"
+            params.append(before_checkpoint_id)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and limit <= 0:
+                break
+            if filter:
+                metadata = self.serde.loads_typed((row[4], row[5]))
+                if not all(metadata.get(key) == value for key, value in filter.items()):
+                    continue
+            if limit is not None:
+                limit -= 1
+            with self._lock:
+                checkpoint_tuple = self._checkpoint_tuple(thread_id, checkpoint_ns, tuple(row))
+            yield checkpoint_tuple
+
+    # Writing checkpoints
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        """Save a checkpoint, then apply the retention policies every prune_every checkpoints."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        stored = checkpoint.copy()
+        stored.pop("pending_sends", None)
+        checkpoint_type, checkpoint_blob = self.serde.dumps_typed(stored)
+        metadata_type, metadata_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    thread_id,
+                    checkpoint_ns,
+                    checkpoint["id"],
+                    config["configurable"].get("checkpoint_id"),
+                    checkpoint_type,
+                    checkpoint_blob,
+                    metadata_type,
+                    metadata_blob,
+                ),
+            )
+            self._connection.execute(
+                "INSERT INTO threads (thread_id, updated_at, completed) VALUES (?, ?, 0) "
+                "ON CONFLICT (thread_id) DO UPDATE SET updated_at = excluded.updated_at, completed = 0",
+                (thread_id, time.time()),
+            )
+            self._trim_thread(thread_id, checkpoint_ns)
+            self._connection.commit()
+            self._puts += 1
+            if self._puts % self.prune_every == 0:
+                self._prune_completed()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        """Save the pending writes of a task against a checkpoint."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # Special writes (errors, interrupts) have negative indexes and replace earlier ones, regular writes are only stored once
+        rows = {"REPLACE": [], "IGNORE": []}
+        for idx, (channel, value) in enumerate(writes):
+            write_idx = WRITES_IDX_MAP.get(channel, idx)
+            value_type, value_blob = self.serde.dumps_typed(value)
+            rows["REPLACE" if write_idx < 0 else "IGNORE"].append(
+                (thread_id, checkpoint_ns, checkpoint_id, task_id, write_idx, channel, value_type, value_blob, task_path)
+            )
+        with self._lock:
+            for conflict, conflict_rows in rows.items():
+                self._connection.executemany(f"INSERT OR {conflict} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", conflict_rows)
+            self._connection.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        """Delete every checkpoint and write of a thread."""
+        with self._lock:
+            self._delete_threads([thread_id])
+            self._connection.commit()
+
+    # Retention and compaction
+    def mark_completed(self, thread_id: str) -> None:
+        """Mark a thread as completed, making it eligible for deletion once completed_ttl_seconds have passed."""
+        with self._lock:
+            self._connection.execute("UPDATE threads SET completed = 1, updated_at = ? WHERE thread_id = ?", (time.time(), thread_id))
+            self._connection.commit()
+
+    def _trim_thread(self, thread_id: str, checkpoint_ns: str):
+        stale = [
+            checkpoint_id
+            for (checkpoint_id,) in self._connection.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?",
+                (thread_id, checkpoint_ns, self.keep_last),
+            )
+        ]
+        for table in ("checkpoints", "writes"):
+            self._connection.executemany(
+                f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                [(thread_id, checkpoint_ns, checkpoint_id) for checkpoint_id in stale],
+            )
+
+    def _delete_threads(self, thread_ids: Sequence[str]):
+        for table in ("checkpoints", "writes", "threads"):
+            self._connection.executemany(f"DELETE FROM {table} WHERE thread_id = ?", [(thread_id,) for thread_id in thread_ids])
+
+    def _prune_completed(self) -> int:
+        expired = [
+            thread_id
+            for (thread_id,) in self._connection.execute(
+                "SELECT thread_id FROM threads WHERE completed = 1 AND updated_at < ?",
+                (time.time() - self.completed_ttl_seconds,),
+            )
+        ]
+        self._delete_threads(expired)
+        self._connection.commit()
+        return len(expired)
+
+    def compact(self) -> int:
+        """Delete expired completed threads and reclaim the disk space they used. Returns the number of threads deleted."""
+        with self._lock:
+            deleted = self._prune_completed()
+            self._connection.execute("VACUUM")
+        return deleted
+
+    # Async versions, SQLite calls are fast enough to run inline
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return self.get_tuple(config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        return self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return self.delete_thread(thread_id)
+
+    def get_next_version(self, current: Optional[str], channel: Any) -> str:
+        # Same version format as MemorySaver: a zero padded counter, plus a random suffix to break ties
+        if current is None:
+            current_version = 0
+        elif isinstance(current, int):
+            current_version = current
+        else:
+            current_version = int(current.split(".")[0])
+        return f"{current_version + 1:032}.{random.random():016}"
+
+def create_checkpointer(backend: str = checkpointer_backend) -> BaseCheckpointSaver:
+    """
+    Creates the checkpointer for the agent graph.
+
+    Args:
+        backend (str): "memory" keeps every checkpoint in process memory, "sqlite" stores them durably
+            in checkpoint_db_path with retention policies. Defaults to config.checkpointer_backend.
+    """
+    if backend == "sqlite":
+        return SQLiteCheckpointer()
+    if backend == "memory":
+        return MemorySaver()
+    raise ValueError(f"Unknown checkpointer backend: {backend}")
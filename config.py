@@ -1,8 +1,97 @@
 
 # LLM configs
 use_local_llm=False
+llm_provider = "ollama" if use_local_llm else "openai" # "openai", "ollama", or "fake" for a deterministic offline stand-in
 ollama_llm="qwen2.5:7b"
 openai_llm="gpt-4o"
+route_small_steps_to_local_llm = False # Classify and critique with the local Ollama model, needs an Ollama server even when llm_provider is "openai"
+# Model of each agent graph route and the model it falls back to when a call fails, as "provider:model", None for llm_provider's model.
+# Classification and critique are simple enough for a small local model, generation uses the large one
+model_routes = {
+    "classify": (f"ollama:{ollama_llm}", None) if route_small_steps_to_local_llm else (None, None),
+    "critique": (f"ollama:{ollama_llm}", None) if route_small_steps_to_local_llm else (None, None),
+    "generate": (None, f"ollama:{ollama_llm}") if route_small_steps_to_local_llm else (None, None),
+}
+fused_classify_generate = False # Classify and generate in one structured call, instead of classifying first
+llm_max_concurrency = 8 # Maximum concurrent requests made by call_llm_batch
+http_max_connections = 32 # Connections per pooled HTTP client, shared by every call to a provider
+http_max_keepalive_connections = 16 # Idle connections kept open for reuse
+http_keepalive_expiry_seconds = 60
+llm_timeout_seconds = 120 # Deadline of each LLM call, retries included
+llm_max_retries = 3 # Retries of LLM calls failing with timeouts, connection errors, rate limiting or server errors
+llm_retry_base_delay_seconds = 0.5 # Maximum delay before the first retry, doubling for each later one, randomised with full jitter
+llm_retry_max_delay_seconds = 8
+llm_hedging_enabled = False # Send a duplicate request once a call is slower than the model's p95 latency, using the first valid response
+llm_hedge_min_delay_seconds = 1.0 # Never hedge sooner than this
+llm_rate_limits = {"openai": (8, 16), "ollama": None} # Client-side (requests/sec, burst) per provider, None for no limit
+
+# LLM response cache
+llm_cache_enabled = True # Set to False to bypass the cache for every call
+llm_cache_path = "llm_cache.sqlite"
+llm_cache_max_entries = 10000
+llm_cache_max_bytes = 100_000_000
+llm_cache_ttl_seconds = 30 * 24 * 60 * 60
+
+# Retrieval configs
+embedding_provider = "ollama" if use_local_llm else "openai" # "openai", "ollama", or "fake" for a deterministic offline stand-in
+openai_embedding_model = "text-embedding-ada-002"
+ollama_embedding_model = "nomic-embed-text"
+embedding_batch_sizes = {"openai": 1000, "ollama": 64, "fake": 1000} # Texts per embedding request, by provider
+embedding_cache_enabled = True # Cache embeddings by content hash, shared by ingestion and queries
+embedding_cache_path = "embedding_cache.sqlite"
+embedding_cache_max_entries = 1_000_000
+vector_search_mode = "exact" # "exact" or "approximate" (IVF, for large example corpora)
+vector_index_mmap = False # Memory-map the embedding matrix instead of loading it into memory
+vector_search_nprobe = 8 # IVF lists scanned per query in approximate mode, higher means better recall but slower
+speculative_retrieval = False # Retrieve examples for the likely types while the type is classified, keeping only the winner's
+speculative_retrieval_types = None # Types retrieved speculatively, None for every type in DND_MAP
+semantic_cache_enabled = True # Answer near-duplicates of already converted descriptions from their saved results
+semantic_cache_threshold = 0.95 # Minimum cosine similarity of the descriptions, depends on the embedding model
+prompt_examples_token_budget = 1000 # Tokens of retrieved examples per prompt, the least similar examples are dropped to fit
+retrieval_same_system_only = False # Only use examples of the target D&D system, e.g. "D&D 5e", as the index holds every system
+
+# Agent checkpoints
+checkpointer_backend = "sqlite" # "sqlite" for durable, bounded checkpoints or "memory" to keep them in process memory
+checkpoint_db_path = "checkpoints.sqlite"
+checkpoint_keep_last = 3 # Checkpoints kept per thread
+checkpoint_completed_ttl_seconds = 24 * 60 * 60 # Completed threads are deleted once this old
+checkpoint_prune_every = 1000 # Checkpoints written between retention passes
 
 # Storage paths
-dnd_converter_outputs_name = "dnd_converter_outputs"
\ No newline at end of file
+dnd_converter_outputs_name = "dnd_converter_outputs"
+
+# Output store
+output_store_backend = "sqlite" # "sqlite" for one SQLite file of all outputs, or "csv" for one CSV per type
+output_store_path = f"{dnd_converter_outputs_name}.sqlite"
+output_store_flush_every = 20 # Rows buffered before they are written
+output_store_flush_interval_seconds = 5 # Maximum time a row is buffered before the next append writes it
+
+# Orchestrator pipeline
+pipeline_stage_workers = {"effect": 4, "classify": 4, "generate": 4} # Worker threads per stage
+pipeline_queue_size = 8 # Items waiting per stage, beyond which the previous stage blocks
+
+# HTTP service
+service_host = "127.0.0.1"
+service_port = 8080
+service_max_concurrency = 4 # Requests executed at once, each one an LLM call chain or agent graph run
+service_max_queue = 64 # Requests waiting for a slot, beyond which new requests are rejected with 503
+service_max_body_bytes = 1_000_000
+
+# Fake providers, for offline benchmarks
+fake_llm_latency_seconds = 0.0 # Simulated latency of each fake LLM call
+fake_embedding_dim = 256
+fake_embedding_latency_seconds = 0.0 # Simulated latency of each fake embedding request
+
+# Metrics
+metrics_enabled = True
+metrics_log_path = None # JSON lines file logging every LLM call, node run, retrieval and embedding request, None to disable
+metrics_prometheus_path = "metrics.prom" # Prometheus text file written on exit, None to disable
+metrics_host = "127.0.0.1" # Interface of the Prometheus endpoint, "0.0.0.0" exposes cost and token metrics on every interface
+metrics_port = 9464 # Port of the Prometheus endpoint started by metrics.serve()
+# USD per million (input, output) tokens, used to estimate costs. Models without a price, e.g. local ones, cost nothing
+llm_costs_per_million_tokens = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+}
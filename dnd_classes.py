@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Literal, Optional, List
+from typing import Literal, Optional, List, Union
 
 class DnDType(BaseModel):
     type: Literal['Magic Item', 'Spell', 'Regular Item', 'Creature', 'Other']
@@ -41,10 +41,35 @@ class DnDEffect(BaseModel):
     effect_description: str
     flavour_text: str
 
+class ReflectionVerdict(BaseModel):
+    critique: str
+    score: int # From 1 (poor) to 10 (excellent)
+    verdict: Literal['accept', 'revise']
+
 DND_MAP = {
     "Magic Item": DnDItem,
     "Spell": DnDSpell,
     "Regular Item": DnDItem,
     "Creature": DnDAny,
     "Other": DnDAny
-}
\ No newline at end of file
+}
+
+# Stat blocks tagged with their D&D type, so one structured call can classify and generate.
+# The tags are disjoint literals, so exactly one member of the union validates: it is discriminated by type
+# without a pydantic discriminator, whose oneOf schema OpenAI strict structured outputs do not accept.
+class TypedDnDItem(DnDItem):
+    type: Literal['Magic Item', 'Regular Item']
+
+class TypedDnDSpell(DnDSpell):
+    type: Literal['Spell']
+
+class TypedDnDAny(DnDAny):
+    type: Literal['Creature', 'Other']
+
+class DnDTypedObject(BaseModel):
+    stat_block: Union[TypedDnDItem, TypedDnDSpell, TypedDnDAny]
+
+    def split(self) -> tuple[str, BaseModel]:
+        """The D&D type and the stat block as its DND_MAP model, without the type tag."""
+        dnd_type = self.stat_block.type
+        return dnd_type, DND_MAP[dnd_type].model_validate(self.stat_block.model_dump(exclude={"type"}))
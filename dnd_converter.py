@@ -1,35 +1,89 @@
 import json
-from llm_tools import call_llm
-from llm_prompts import TYPE_PROMPT_TEMPLATE, OBJECT_TEMPLATE
-from dnd_classes import DnDType, DND_MAP
+from pydantic import BaseModel
+from llm_tools import acall_llm, call_llm, stream_llm
+from llm_prompts import TYPE_PROMPT_TEMPLATE, OBJECT_TEMPLATE, TYPED_OBJECT_TEMPLATE
+from dnd_classes import DnDType, DnDTypedObject, DND_MAP
+from config import fused_classify_generate
 
-def systematise_magic(description, system="D&D 5e"):
+def stream_stat_block(prompt, entity_model, wrapper_field=None):
+    """
+    Print each stat block field as soon as it is complete, and return the validated stat block.
+    For models wrapping the stat block in a field, e.g. DnDTypedObject, wrapper_field names that field.
+    """
+    printed = set()
+    for update in stream_llm(prompt, entity_model):
+        if isinstance(update, entity_model):
+            fields = update.model_dump()
+            for field, value in (fields[wrapper_field] if wrapper_field else fields).items():
+                if field not in printed:
+                    print(f"{field}: {value}", flush=True)
+            return update
+        if wrapper_field:
+            update = update.get(wrapper_field) or {}
+        # A field is complete once the model has started on the next one
+        for field in list(update)[:-1]:
+            if field not in printed:
+                printed.add(field)
+                print(f"{field}: {update[field]}", flush=True)
 
-    prompt = TYPE_PROMPT_TEMPLATE.format(description=description, system=system)
+def systematise_magic_fused(description, system="D&D 5e", stream=False):
+    """Classify and generate the stat block in a single structured LLM call."""
+    prompt = TYPED_OBJECT_TEMPLATE.format(description=description, system=system)
     print("Sending to LLM...")
 
     try:
-        response = call_llm(prompt, DnDType)
-        entity_type = response.type
+        response = stream_stat_block(prompt, DnDTypedObject, "stat_block") if stream else call_llm(prompt, DnDTypedObject)
+        entity_type, stat_block = response.split()
         print(f"Entity type: {entity_type}")
+        item_data = stat_block.model_dump()
+        print(json.dumps(item_data, indent=2))
     except Exception as e:
         print(f"Error: {e}")
 
+def classify(description: str, system: str = "D&D 5e") -> str:
+    """Classify a description into one of the DND_MAP types."""
+    return call_llm(TYPE_PROMPT_TEMPLATE.format(description=description, system=system), DnDType).type
 
+def generate_stat_block(entity_type: str, description: str, system: str = "D&D 5e", stream: bool = False) -> BaseModel:
+    """Generate the stat block of a classified description, printing its fields as they are generated if stream is set."""
     prompt = OBJECT_TEMPLATE.format(dnd_type=entity_type, description=description, system=system)
     entity_model = DND_MAP[entity_type]
+    return stream_stat_block(prompt, entity_model) if stream else call_llm(prompt, entity_model)
+
+def systematise_magic(description, system="D&D 5e", stream=False, fused=fused_classify_generate):
+    if fused:
+        return systematise_magic_fused(description, system, stream=stream)
 
     print("Sending to LLM...")
 
     try:
-        response = call_llm(prompt, entity_model)
+        entity_type = classify(description, system)
+        print(f"Entity type: {entity_type}")
+    except Exception as e:
+        # Without a type there is no stat block model to generate
+        print(f"Error: {e}")
+        return
+
+    print("Sending to LLM...")
+
+    try:
+        response = generate_stat_block(entity_type, description, system, stream=stream)
         item_data = response.model_dump()
         print(json.dumps(item_data, indent=2))
     except Exception as e:
         print(f"Error: {e}")
 
+async def asystematise(description: str, system: str = "D&D 5e", fused: bool = fused_classify_generate) -> tuple[str, BaseModel]:
+    """Asynchronously classify a description and generate its stat block, returning the D&D type and the stat block."""
+    if fused:
+        response = await acall_llm(TYPED_OBJECT_TEMPLATE.format(description=description, system=system), DnDTypedObject)
+        return response.split()
+    entity_type = (await acall_llm(TYPE_PROMPT_TEMPLATE.format(description=description, system=system), DnDType)).type
+    prompt = OBJECT_TEMPLATE.format(dnd_type=entity_type, description=description, system=system)
+    return entity_type, await acall_llm(prompt, DND_MAP[entity_type])
+
 def main():
-    systematise_magic("A metal scimitar that is engulfed by flame.")
+    systematise_magic("A metal scimitar that is engulfed by flame.", stream=True)
 
 if __name__ == "__main__":
     main()
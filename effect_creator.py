@@ -1,23 +1,38 @@
-from llm_tools import call_llm
+from llm_tools import acall_llm, call_llm, stream_llm
 from llm_prompts import MAGIC_PROMPT_TEMPLATE
 
-def create_effect(description: str):
+def generate_effect(description: str) -> str:
+    """Create the magical effect of a description, raising any error to the caller."""
+    return call_llm(MAGIC_PROMPT_TEMPLATE.format(description=description))
+
+def create_effect(description: str, stream: bool = False):
 
     prompt = MAGIC_PROMPT_TEMPLATE.format(description=description)
     print("Sending to LLM...")
 
     try:
-        response = call_llm(prompt)
+        if stream:
+            # Print the effect as it is generated
+            print("Effect: ", end="", flush=True)
+            response = ""
+            for chunk in stream_llm(prompt):
+                print(chunk, end="", flush=True)
+                response += chunk
+            print()
+            return response
+        response = generate_effect(description)
         print(f"Effect: {response}")
         return response
     except Exception as e:
         print(f"Error: {e}")
         return "There is no effect."
 
-
+async def acreate_effect(description: str) -> str:
+    """Asynchronously create the magical effect of a description, raising any error to the caller."""
+    return await acall_llm(MAGIC_PROMPT_TEMPLATE.format(description=description))
 
 def main():
-    create_effect("A group of five adventurers gather by a fire holding elemental gems of type fire, water, ice, earth and air chanting 'rage' over and over again.")
+    create_effect("A group of five adventurers gather by a fire holding elemental gems of type fire, water, ice, earth and air chanting 'rage' over and over again.", stream=True)
 
 if __name__ == "__main__":
     main()
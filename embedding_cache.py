@@ -0,0 +1,118 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import List
+import numpy as np
+from config import embedding_cache_enabled, embedding_cache_path, embedding_cache_max_entries
+
+def embedding_key(model: str, text: str, kind: str = "document") -> str:
+    """
+    Cache key of a text's embedding, the hash of the embedding model, the text and whether it was embedded as a
+    "document" or a "query". Document keys leave the kind out, so they match the keys cached before it was added.
+    """
+    payload = f"{model}\n{text}" if kind == "document" else f"{model}\n{kind}\n{text}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Disk-backed cache of embeddings keyed by model and content hash, stored in SQLite as float32 blobs.
+
+    Embeddings never change for the same model and text, so entries do not expire,
+    the oldest entries are evicted once the cache holds more than max_entries.
+    Hits and misses are counted for the lifetime of the process.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = embedding_cache_path,
+        max_entries: int = embedding_cache_max_entries,
+        enabled: bool = embedding_cache_enabled,
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        # Number of cached embeddings, tracked on every write so writes do not scan the table
+        self._entries = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connect on first use, so importing the module never touches the disk
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS embedding_cache_created_at ON embedding_cache (created_at)")
+            self._connection.commit()
+            self._entries = self._count(self._connection)
+        return self._connection
+
+    @staticmethod
+    def _count(connection: sqlite3.Connection) -> int:
+        return connection.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> dict[str, List[float]]:
+        """The cached embeddings of the keys that are in the cache."""
+        if not self.enabled or not keys:
+            return {}
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            # Stay below SQLite's limit on query parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update({key: np.frombuffer(vector, dtype=np.float32).tolist() for key, vector in rows})
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, embeddings: dict[str, List[float]]):
+        """Store embeddings by key, evicting the oldest entries if the cache is over its limit."""
+        if not self.enabled or not embeddings:
+            return
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            # An embedding never changes for the same key, so keys already cached are left as they are
+            # and the number of inserted rows is the number of new entries
+            changes = connection.total_changes
+            connection.executemany(
+                "INSERT OR IGNORE INTO embedding_cache (key, vector, created_at) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in embeddings.items()],
+            )
+            self._entries += connection.total_changes - changes
+            if self._entries > self.max_entries:
+                # Evict at least a tenth of the cache at a time, so eviction does not run on every write.
+                # Recount afterwards, other processes sharing the file may have changed it
+                excess = max(self._entries - self.max_entries, self._entries // 10)
+                connection.execute(
+                    "DELETE FROM embedding_cache WHERE key IN (SELECT key FROM embedding_cache ORDER BY created_at ASC LIMIT ?)", (excess,)
+                )
+                self._entries = self._count(connection)
+            connection.commit()
+
+    def clear(self):
+        """Remove every cached embedding."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM embedding_cache")
+            connection.commit()
+            self._entries = 0
+
+    def stats(self) -> dict:
+        """Hit and miss counters for this process, plus the current number of cached embeddings."""
+        with self._lock:
+            entries = self._count(self._connect())
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": entries}
+
+# Cache shared by document ingestion and query embedding
+embedding_cache = EmbeddingCache()
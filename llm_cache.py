@@ -0,0 +1,153 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Optional
+from config import llm_cache_enabled, llm_cache_path, llm_cache_max_entries, llm_cache_max_bytes, llm_cache_ttl_seconds
+
+@lru_cache(maxsize=None)
+def json_schema(output_format: Any) -> dict:
+    """A pydantic model's JSON schema, generated once per model. Callers must not modify it."""
+    return output_format.model_json_schema()
+
+@lru_cache(maxsize=None)
+def schema_hash(output_format: Optional[Any]) -> Optional[str]:
+    """Hash of a pydantic model's JSON schema, so cached outputs are invalidated when the schema changes."""
+    if output_format is None:
+        return None
+    schema = json.dumps(json_schema(output_format), sort_keys=True)
+    return hashlib.sha256(schema.encode("utf-8")).hexdigest()
+
+# Expired entries are also removed when they are read, so the whole table is only swept this often
+SWEEP_INTERVAL_SECONDS = 60 * 60
+
+class LLMCache:
+    """
+    Disk-backed cache of LLM responses, stored in SQLite.
+
+    Entries are evicted least recently used first once the cache holds more than max_entries entries
+    or max_bytes bytes of responses, and expire ttl_seconds after they were written.
+    Hits and misses are counted for the lifetime of the process.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = llm_cache_path,
+        max_entries: int = llm_cache_max_entries,
+        max_bytes: int = llm_cache_max_bytes,
+        ttl_seconds: float = llm_cache_ttl_seconds,
+        enabled: bool = llm_cache_enabled,
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        # Entries and bytes of responses, tracked on every write so writes do not scan the table
+        self._entries = 0
+        self._bytes = 0
+        self._last_sweep = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connect on first use, so importing the module never touches the disk
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+            self._connection.commit()
+            self._entries, self._bytes = self._totals(self._connection)
+        return self._connection
+
+    @staticmethod
+    def _totals(connection: sqlite3.Connection) -> tuple[int, int]:
+        return connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM llm_cache").fetchone()
+
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        """Build a cache key from the parts identifying a request, e.g. model, temperature, prompt and schema hash."""
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for a key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.ttl_seconds:
+                connection.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                connection.commit()
+                self._entries -= 1
+                self._bytes -= len(row[0])
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, value: str):
+        """Store a response, evicting the least recently used entries if the cache is over its limits."""
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            replaced = connection.execute("SELECT LENGTH(value) FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._entries += replaced is None
+            self._bytes += len(value) - (replaced[0] if replaced else 0)
+            self._evict(connection, now)
+            connection.commit()
+
+    def _evict(self, connection: sqlite3.Connection, now: float):
+        # The table is only scanned by the periodic sweep and once the tracked totals are over a limit.
+        # Both recount the totals, which other processes sharing the file may have changed
+        if now - self._last_sweep >= SWEEP_INTERVAL_SECONDS:
+            connection.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._entries, self._bytes = self._totals(connection)
+            self._last_sweep = now
+        while self._entries > self.max_entries or self._bytes > self.max_bytes:
+            # Evict at least a tenth of the cache at a time, so eviction does not run on every write
+            excess = max(self._entries - self.max_entries, self._entries // 10, 1)
+            connection.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)", (excess,)
+            )
+            self._entries, self._bytes = self._totals(connection)
+
+    def clear(self):
+        """Remove every cached response."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM llm_cache")
+            connection.commit()
+            self._entries = self._bytes = 0
+
+    def stats(self) -> dict:
+        """Hit and miss counters for this process, plus the current size of the cache."""
+        with self._lock:
+            entries, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(value)), 0) FROM llm_cache").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+# Cache shared by call_llm and the agent graph's chat models
+llm_cache = LLMCache()
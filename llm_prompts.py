@@ -23,6 +23,21 @@ Target System: {system}
 
 """
 
+TYPED_OBJECT_TEMPLATE = """
+You are a fantasy RPG generator and dungeons and dragons dungeon master. Given a description of an entity or magical force in a fantasy universe and a target game system, first determine its type, then output a structured stat block of that type appropriate to that system.
+Magic items are items made from rare materials, or enchanted by a spellcaster.
+Spells could be one-time spells, or could have longer duration. For example, transforming someone into a frog for an hour is a spell. 
+Rituals, for example a ritual of water breathing, are spells too. Rituals typically have stronger effects then one-time spells, since they take longer to cast.
+Creatures refer to summoned creatures, e.g familiars, undead or mounts. 
+Set the type of the stat block to the type you determined.
+
+Description:
+"{description}"
+
+Target System: {system}
+
+"""
+
 SIMILAR_OBJECTS_TEMPLATE = """
 Here are some examples of {dnd_type}s that could be similar, use them as a guide in creating this {dnd_type}. 
 Examples:
@@ -34,6 +49,7 @@ REFLECTION_PROMPT = """
 You are a critic of a fantasy RPG {dnd_type} generator. The generatator has produced a {dnd_type} stat block based on a description and a target game system. Critique the {dnd_type} stat block and provide feedback on how it could be improved.
 Give preference to more concise stat blocks with more interesting effects, and check that the generated {dnd_type} is a good thematic match with the description. If the {dnd_type} stat block is already good, say so.
 Give at most two recommendations.
+Score the {dnd_type} stat block from 1 (poor) to 10 (excellent). Give the verdict accept if it is already good, or revise if it should be revised.
 
 Description:
 "{description}"
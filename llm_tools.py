@@ -1,65 +1,372 @@
-import ollama
+import asyncio
+import time
+import weakref
 from dotenv import load_dotenv
-from config import use_local_llm, ollama_llm, openai_llm
-from typing import Any, Optional
-from openai import OpenAI
+from config import (
+    llm_provider,
+    ollama_llm,
+    openai_llm,
+    llm_max_concurrency,
+    http_max_connections,
+    http_max_keepalive_connections,
+    http_keepalive_expiry_seconds,
+)
+from typing import Any, Iterator, List, Optional
+from llm_cache import llm_cache, json_schema, schema_hash
+from metrics import metrics
+from resilience import aresilient_call, resilient_call, wait_for_rate_limit
 
 load_dotenv()
-client = OpenAI()
 
-def call_llm(prompt: str, output_format: Optional[Any] = None) -> str:
-    """Call the LLM API with a prompt."""
-    if use_local_llm:
-        return call_ollama(prompt, output_format)
+# The provider SDKs are imported and their clients created on first use, so only the configured provider is ever loaded
+_openai_client = None
+_ollama_client = None
+_http_client = None
+
+def http_limits():
+    """Connection pool limits of every HTTP client talking to a provider."""
+    import httpx
+    return httpx.Limits(
+        max_connections=http_max_connections,
+        max_keepalive_connections=http_max_keepalive_connections,
+        keepalive_expiry=http_keepalive_expiry_seconds,
+    )
+
+def get_http_client():
+    """
+    The HTTP client shared by the OpenAI client and the agent graph's chat model, created on first use.
+    Its pool keeps connections alive between calls, so requests skip the TCP and TLS handshakes.
+    """
+    global _http_client
+    if _http_client is None:
+        import httpx
+        from openai import DEFAULT_TIMEOUT
+        _http_client = httpx.Client(limits=http_limits(), timeout=DEFAULT_TIMEOUT, follow_redirects=True)
+    return _http_client
+
+def get_openai_client():
+    """The OpenAI client shared by the process, created on first use."""
+    global _openai_client
+    if _openai_client is None:
+        from openai import OpenAI
+        # Retries are made by the resilience layer, which also knows the deadline
+        _openai_client = OpenAI(http_client=get_http_client(), max_retries=0)
+    return _openai_client
+
+def get_ollama_client():
+    """The Ollama client shared by the process, created on first use."""
+    global _ollama_client
+    if _ollama_client is None:
+        import ollama
+        _ollama_client = ollama.Client(limits=http_limits())
+    return _ollama_client
+
+# Async clients hold connection pools bound to an event loop, so they are created once per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+def _get_async_client(provider: str):
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if provider not in clients:
+        import httpx
+        if provider == "openai":
+            from openai import DEFAULT_TIMEOUT, AsyncOpenAI
+            clients[provider] = AsyncOpenAI(
+                http_client=httpx.AsyncClient(limits=http_limits(), timeout=DEFAULT_TIMEOUT, follow_redirects=True),
+                max_retries=0,
+            )
+        else:
+            import ollama
+            clients[provider] = ollama.AsyncClient(limits=http_limits())
+    return clients[provider]
+
+def call_llm(prompt: str, output_format: Optional[Any] = None, use_cache: bool = True) -> str:
+    """Call the configured LLM provider with a prompt. Set use_cache=False to bypass the response cache."""
+    if llm_provider == "fake":
+        return call_fake(prompt, output_format, use_cache=use_cache)
+    elif llm_provider == "ollama":
+        return call_ollama(prompt, output_format, use_cache=use_cache)
     else:
-        return call_openai(prompt, output_format)
+        return call_openai(prompt, output_format, use_cache=use_cache)
+
+def _cache_key(llm: str, prompt: str, output_format: Any, use_cache: bool) -> Optional[str]:
+    if not use_cache or not llm_cache.enabled:
+        return None
+    return llm_cache.make_key(model=llm, temperature=None, prompt=prompt, schema=schema_hash(output_format))
+
+def _from_cache(key: Optional[str], output_format: Any):
+    """Return the cached response for a key, rehydrated into output_format for structured outputs."""
+    if key is None:
+        return None
+    cached = llm_cache.get(key)
+    if cached is None or not output_format:
+        return cached
+    return output_format.model_validate_json(cached)
+
+def _to_cache(key: Optional[str], result: Any, output_format: Any):
+    if key is not None and result is not None:
+        llm_cache.set(key, result.model_dump_json() if output_format else result)
+
+def _ollama_kwargs(prompt: str, output_format: Any, llm: str) -> dict:
+    kwargs = {
+        "model": llm,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+    }
+    if output_format:
+        kwargs["format"] = json_schema(output_format)
+    return kwargs
+
+def _parse_ollama_response(response, output_format: Any):
+    if output_format:
+        return output_format.model_validate_json(response.message.content)
+    return response.message.content
 
-def call_ollama(prompt: str, output_format: Any, llm: str = ollama_llm) -> str:
+def _ollama_usage(response) -> tuple[int, int]:
+    return response.prompt_eval_count or 0, response.eval_count or 0
+
+def call_ollama(prompt: str, output_format: Any, llm: str = ollama_llm, use_cache: bool = True) -> str:
     """Call the local Ollama API with a prompt."""
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call("ollama", llm, cached=True)
+        return cached
     print("calling ollama")
+
+    def request():
+        # Parsed inside the request, so an invalid structured response counts as a failed one
+        start = time.perf_counter()
+        response = get_ollama_client().chat(**_ollama_kwargs(prompt, output_format, llm))
+        metrics.record_llm_call("ollama", llm, time.perf_counter() - start, *_ollama_usage(response))
+        return _parse_ollama_response(response, output_format)
+    result = resilient_call(request, "ollama", llm)
+    _to_cache(key, result, output_format)
+    return result
+
+def _openai_kwargs(prompt: str, output_format: Any, llm: str) -> dict:
+    kwargs = {
+        "model": llm,
+        "input": [
+            {
+                "role": "user",
+                "content": prompt,
+            },
+        ],
+    }
     if output_format:
-        print("main output format.")
-        response = ollama.chat(
-            model=llm,
-            format=output_format.model_json_schema(),
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return output_format.model_validate_json(response.message.content)
-    else:
-        response = ollama.chat(
-            model=llm,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.message.content
+        kwargs["text_format"] = output_format
+    return kwargs
 
+def _parse_openai_response(response, output_format: Any):
+    if output_format:
+        return response.output_parsed
+    # Without a text_format there is nothing to parse, the answer is the plain output text
+    return response.output_text
+
+def _openai_usage(response) -> tuple[int, int]:
+    if response.usage is None:
+        return 0, 0
+    return response.usage.input_tokens, response.usage.output_tokens
 
-def call_openai(prompt: str, output_format: Any, llm: str = openai_llm) -> str:
+def call_openai(prompt: str, output_format: Any, llm: str = openai_llm, use_cache: bool = True) -> str:
     """Call the OpenAI API with a prompt."""
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call("openai", llm, cached=True)
+        return cached
     print("calling openai")
-    if output_format:
-        response = client.responses.parse(
-            model=llm,
-            input=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                },
-            ],
-            text_format=output_format,
-        )
-        return response.output_parsed
+
+    def request():
+        start = time.perf_counter()
+        response = get_openai_client().responses.parse(**_openai_kwargs(prompt, output_format, llm))
+        metrics.record_llm_call("openai", llm, time.perf_counter() - start, *_openai_usage(response))
+        return _parse_openai_response(response, output_format)
+    result = resilient_call(request, "openai", llm)
+    _to_cache(key, result, output_format)
+    return result
+
+def call_fake(prompt: str, output_format: Any, llm: str = "fake", use_cache: bool = True) -> str:
+    """Call the deterministic offline stand-in for the LLM APIs, used by the benchmarks."""
+    from providers import fake_token_counts, get_fake_llm
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call("fake", llm, cached=True)
+        return cached
+
+    def request():
+        start = time.perf_counter()
+        result = get_fake_llm().call(prompt, output_format)
+        usage = fake_token_counts(prompt, result.model_dump_json() if output_format else result)
+        metrics.record_llm_call("fake", llm, time.perf_counter() - start, *usage)
+        return result
+    result = resilient_call(request, "fake", llm)
+    _to_cache(key, result, output_format)
+    return result
+
+def stream_llm(prompt: str, output_format: Optional[Any] = None, use_cache: bool = True) -> Iterator:
+    """
+    Stream the LLM response to a prompt.
+
+    Free-text prompts yield text chunks as they arrive. Structured prompts yield a dict of the fields parsed
+    from the partial JSON each time it changes, and finally the validated output_format instance.
+    A cached response is yielded whole.
+    """
+    llm = {"openai": openai_llm, "ollama": ollama_llm}.get(llm_provider, "fake")
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call(llm_provider, llm, cached=True)
+        yield cached
+        return
+
+    if llm_provider == "fake":
+        from providers import get_fake_llm
+        chunks = get_fake_llm().stream(prompt, output_format)
+    elif llm_provider == "ollama":
+        chunks = _stream_ollama(prompt, output_format, llm)
     else:
-        response = client.responses.parse(
-            model=llm,
-            input=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                },
-            ],
-        )
-        return response.output_parsed
\ No newline at end of file
+        chunks = _stream_openai(prompt, output_format, llm)
+    if not output_format:
+        text = []
+        for chunk in chunks:
+            text.append(chunk)
+            yield chunk
+        _to_cache(key, "".join(text), output_format)
+        return
+
+    # Only needed for structured streaming, so it is not loaded for every call
+    from langchain_core.utils.json import parse_partial_json
+    text, partial = "", None
+    for chunk in chunks:
+        text += chunk
+        parsed = parse_partial_json(text)
+        if isinstance(parsed, dict) and parsed != partial:
+            partial = parsed
+            yield partial
+    result = output_format.model_validate_json(text)
+    _to_cache(key, result, output_format)
+    yield result
+
+def _stream_ollama(prompt: str, output_format: Any, llm: str) -> Iterator[str]:
+    print("calling ollama")
+    # Streams are printed as they arrive, so they are rate limited but not retried or hedged
+    wait_for_rate_limit("ollama")
+    start = time.perf_counter()
+    for chunk in get_ollama_client().chat(**_ollama_kwargs(prompt, output_format, llm), stream=True):
+        if chunk.message.content:
+            yield chunk.message.content
+        if chunk.done:
+            # Token counts are only sent with the last chunk
+            metrics.record_llm_call("ollama", llm, time.perf_counter() - start, *_ollama_usage(chunk))
+
+def _stream_openai(prompt: str, output_format: Any, llm: str) -> Iterator[str]:
+    print("calling openai")
+    wait_for_rate_limit("openai")
+    start = time.perf_counter()
+    with get_openai_client().responses.stream(**_openai_kwargs(prompt, output_format, llm)) as stream:
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed":
+                metrics.record_llm_call("openai", llm, time.perf_counter() - start, *_openai_usage(event.response))
+
+async def acall_llm(prompt: str, output_format: Optional[Any] = None, use_cache: bool = True) -> str:
+    """Asynchronously call the configured LLM provider with a prompt. Set use_cache=False to bypass the response cache."""
+    if llm_provider == "fake":
+        return await acall_fake(prompt, output_format, use_cache=use_cache)
+    elif llm_provider == "ollama":
+        return await acall_ollama(prompt, output_format, use_cache=use_cache)
+    else:
+        return await acall_openai(prompt, output_format, use_cache=use_cache)
+
+async def acall_fake(prompt: str, output_format: Any, llm: str = "fake", use_cache: bool = True) -> str:
+    """Asynchronously call the deterministic offline stand-in for the LLM APIs."""
+    from providers import fake_token_counts, get_fake_llm
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call("fake", llm, cached=True)
+        return cached
+
+    async def request():
+        start = time.perf_counter()
+        result = await get_fake_llm().acall(prompt, output_format)
+        usage = fake_token_counts(prompt, result.model_dump_json() if output_format else result)
+        metrics.record_llm_call("fake", llm, time.perf_counter() - start, *usage)
+        return result
+    result = await aresilient_call(request, "fake", llm)
+    _to_cache(key, result, output_format)
+    return result
+
+async def acall_ollama(prompt: str, output_format: Any, llm: str = ollama_llm, use_cache: bool = True) -> str:
+    """Asynchronously call the local Ollama API with a prompt."""
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call("ollama", llm, cached=True)
+        return cached
+    print("calling ollama")
+
+    async def request():
+        start = time.perf_counter()
+        response = await _get_async_client("ollama").chat(**_ollama_kwargs(prompt, output_format, llm))
+        metrics.record_llm_call("ollama", llm, time.perf_counter() - start, *_ollama_usage(response))
+        return _parse_ollama_response(response, output_format)
+    result = await aresilient_call(request, "ollama", llm)
+    _to_cache(key, result, output_format)
+    return result
+
+async def acall_openai(prompt: str, output_format: Any, llm: str = openai_llm, use_cache: bool = True) -> str:
+    """Asynchronously call the OpenAI API with a prompt."""
+    key = _cache_key(llm, prompt, output_format, use_cache)
+    if (cached := _from_cache(key, output_format)) is not None:
+        metrics.record_llm_call("openai", llm, cached=True)
+        return cached
+    print("calling openai")
+
+    async def request():
+        start = time.perf_counter()
+        response = await _get_async_client("openai").responses.parse(**_openai_kwargs(prompt, output_format, llm))
+        metrics.record_llm_call("openai", llm, time.perf_counter() - start, *_openai_usage(response))
+        return _parse_openai_response(response, output_format)
+    result = await aresilient_call(request, "openai", llm)
+    _to_cache(key, result, output_format)
+    return result
+
+async def acall_llm_batch(
+    prompts: List[str],
+    output_format: Optional[Any] = None,
+    max_concurrency: int = llm_max_concurrency,
+    return_exceptions: bool = False,
+    use_cache: bool = True,
+) -> List:
+    """
+    Call the LLM API with many prompts concurrently, with at most max_concurrency requests in flight.
+
+    Args:
+        prompts (List[str]): The prompts to send.
+        output_format (Optional[Any]): Pydantic model for structured outputs, shared by all prompts.
+        max_concurrency (int): Maximum number of concurrent requests. Defaults to config.llm_max_concurrency.
+        return_exceptions (bool): Return exceptions in place of failed results instead of raising the first one.
+        use_cache (bool): Set to False to bypass the response cache.
+
+    Returns:
+        List: The responses, in the same order as the prompts.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def call_with_limit(prompt: str):
+        async with semaphore:
+            return await acall_llm(prompt, output_format, use_cache=use_cache)
+
+    return await asyncio.gather(*(call_with_limit(prompt) for prompt in prompts), return_exceptions=return_exceptions)
+
+def call_llm_batch(
+    prompts: List[str],
+    output_format: Optional[Any] = None,
+    max_concurrency: int = llm_max_concurrency,
+    return_exceptions: bool = False,
+    use_cache: bool = True,
+) -> List:
+    """
+    Synchronous wrapper around acall_llm_batch, for callers without a running event loop.
+    Returns the responses in the same order as the prompts.
+    """
+    return asyncio.run(acall_llm_batch(prompts, output_format, max_concurrency, return_exceptions, use_cache))
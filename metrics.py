@@ -0,0 +1,238 @@
+import atexit
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator, Optional
+from config import metrics_enabled, metrics_log_path, metrics_prometheus_path, metrics_host, metrics_port, llm_costs_per_million_tokens
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_HELP = {
+    "dnd_llm_calls_total": "LLM calls, by provider, model, graph node and whether the response cache answered them.",
+    "dnd_llm_call_seconds": "Wall-clock time of LLM calls that reached the provider.",
+    "dnd_llm_tokens_total": "Prompt (input) and completion (output) tokens of LLM calls that reached the provider.",
+    "dnd_llm_cost_usd_total": "Estimated cost of LLM calls, from config.llm_costs_per_million_tokens.",
+    "dnd_llm_errors_total": "LLM calls that raised an error.",
+    "dnd_node_seconds": "Wall-clock time of agent graph nodes.",
+    "dnd_retrieval_seconds": "Wall-clock time of similar object retrieval, embedding the query included.",
+    "dnd_embeddings_total": "Texts embedded, by kind (query or document).",
+    "dnd_embedding_seconds": "Wall-clock time of embedding requests.",
+    "dnd_llm_retries_total": "LLM calls retried after a transient error.",
+    "dnd_llm_timeouts_total": "LLM requests abandoned at their deadline.",
+    "dnd_llm_hedges_total": "Duplicate LLM requests sent because the first was slower than the p95 latency.",
+    "dnd_llm_hedge_wins_total": "Hedged LLM calls answered first by the duplicate request.",
+    "dnd_llm_rate_limit_wait_seconds": "Time LLM requests waited for the client-side rate limit.",
+    "dnd_route_seconds": "Wall-clock time of the LLM call of each agent graph route, including any fallback.",
+    "dnd_pipeline_stage_seconds": "Wall-clock time of each item in an orchestrator pipeline stage.",
+    "dnd_service_requests_total": "HTTP service requests, by endpoint and status code.",
+    "dnd_service_request_seconds": "Wall-clock time of HTTP service requests, queueing included.",
+    "dnd_service_coalesced_total": "HTTP service requests answered by an identical request already in flight.",
+    "dnd_prompt_tokens_saved_total": "Prompt tokens saved by compact stat blocks and examples, compared to their repr.",
+    "dnd_prompt_examples_trimmed_total": "Prompts whose retrieved examples were cut to fit the token budget.",
+    "dnd_semantic_cache_total": "Semantic cache lookups, by whether a near-duplicate result was found (hit) or not (miss).",
+    "dnd_semantic_cache_seconds": "Wall-clock time of semantic cache lookups, embedding the description included.",
+    "dnd_embedding_cache_total": "Distinct texts to embed found in (hit) or missing from (miss) the embedding cache.",
+}
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    """Estimated cost in USD of a call, 0 for models without a configured price (e.g. local models)."""
+    prices = llm_costs_per_million_tokens.get(model)
+    if prices is None:
+        # Dated model versions, e.g. gpt-4o-2024-08-06, are priced as their base model
+        prices = next((price for name, price in llm_costs_per_million_tokens.items() if model.startswith(f"{name}-")), None)
+    if prices is None:
+        return 0.0
+    return (input_tokens * prices[0] + output_tokens * prices[1]) / 1_000_000
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels) + "}"
+
+class Metrics:
+    """
+    Process-wide counters and latency histograms, shared by every thread.
+
+    Every recorded LLM call, node run, retrieval and embedding request is also written as one JSON line to log_path, if set.
+    The current values can be exported in the Prometheus text format, to a file or from an HTTP endpoint.
+    """
+
+    def __init__(self, enabled: bool = metrics_enabled, log_path: Optional[str | Path] = metrics_log_path):
+        self.enabled = enabled
+        self.log_path = Path(log_path) if log_path else None
+        self._counters: dict[tuple[str, tuple], float] = {}
+        # Histogram state per series: bucket counts, sum and count
+        self._histograms: dict[tuple[str, tuple], list] = {}
+        self._lock = threading.Lock()
+        self._log_file = None
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        """Add value to a counter."""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a duration in a latency histogram."""
+        if not self.enabled:
+            return
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(LATENCY_BUCKETS), 0.0, 0])
+            index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if index < len(LATENCY_BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, event: Optional[str] = None, **labels) -> Iterator[None]:
+        """Time the body of a with block into a histogram, and log it as event if given."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(name, seconds, **labels)
+            if event:
+                self.log(event, seconds=seconds, **labels)
+
+    def log(self, event: str, **fields):
+        """Write a structured JSON log line, if a log path is configured."""
+        if not self.enabled or self.log_path is None:
+            return
+        line = json.dumps({"time": time.time(), "event": event, **fields}, default=str)
+        with self._lock:
+            if self._log_file is None:
+                self._log_file = open(self.log_path, "a", encoding="utf-8")
+            self._log_file.write(line + "\n")
+            self._log_file.flush()
+
+    def record_llm_call(
+        self,
+        provider: str,
+        model: str,
+        seconds: float = 0.0,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        cached: bool = False,
+        node: Optional[str] = None,
+    ):
+        """Record one LLM call. Cached responses are counted as calls, but add no latency, tokens or cost."""
+        self.inc("dnd_llm_calls_total", provider=provider, model=model, node=node, cache="hit" if cached else "miss")
+        cost = 0.0
+        if cached:
+            input_tokens = output_tokens = 0
+        else:
+            cost = estimate_cost(model, input_tokens, output_tokens)
+            self.observe("dnd_llm_call_seconds", seconds, provider=provider, model=model, node=node)
+            self.inc("dnd_llm_tokens_total", input_tokens, model=model, direction="input")
+            self.inc("dnd_llm_tokens_total", output_tokens, model=model, direction="output")
+            self.inc("dnd_llm_cost_usd_total", cost, model=model)
+        self.log(
+            "llm_call", provider=provider, model=model, node=node, cached=cached, seconds=seconds,
+            input_tokens=input_tokens, output_tokens=output_tokens, cost_usd=cost,
+        )
+
+    def snapshot(self) -> dict:
+        """The current values of every counter, and the count, sum and bucket counts of every histogram."""
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value} for (name, labels), value in self._counters.items()]
+            histograms = [
+                {"name": name, "labels": dict(labels), "count": count, "sum": total, "buckets": dict(zip(LATENCY_BUCKETS, buckets))}
+                for (name, labels), (buckets, total, count) in self._histograms.items()
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        """The current values in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(buckets), total, count)) for key, (buckets, total, count) in self._histograms.items())
+        lines, described = [], set()
+
+        def describe(name: str, metric_type: str):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+        for (name, labels), (buckets, total, count) in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Optional[str | Path] = metrics_prometheus_path) -> Optional[Path]:
+        """Write the Prometheus text to a file, e.g. for the node exporter's textfile collector, once anything was recorded."""
+        if not self.enabled or not path or not (self._counters or self._histograms):
+            return None
+        path = Path(path)
+        temporary_path = path.with_name(path.name + ".tmp")
+        temporary_path.write_text(self.to_prometheus(), encoding="utf-8")
+        # Replace the file in one step, so a scrape never reads a partly written file
+        temporary_path.replace(path)
+        return path
+
+    def serve(self, port: int = metrics_port, host: str = metrics_host) -> ThreadingHTTPServer:
+        """Serve the Prometheus text at http://host:port/metrics from a background thread."""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        print(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+        return server
+
+    def reset(self):
+        """Clear every counter and histogram."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+def timed_node(name: str, node):
+    """Wrap an agent graph node so the wall-clock time of each run is recorded."""
+    def run_node(state):
+        with metrics.timer("dnd_node_seconds", event="node", node=name):
+            return node(state)
+    return run_node
+
+# Metrics shared by the whole process, written to config.metrics_prometheus_path on exit
+metrics = Metrics()
+atexit.register(metrics.write_prometheus)
@@ -1,10 +1,194 @@
-from effect_creator import create_effect
-from dnd_converter import systematise_magic
+import argparse
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+from effect_creator import create_effect, generate_effect
+from dnd_converter import classify, generate_stat_block, systematise_magic
+from config import pipeline_stage_workers, pipeline_queue_size
+from metrics import metrics
 
 EXAMPLE_TEXT = "A group of five adventurers gather by a fire holding elemental gems of type fire, water, ice, earth and air chanting 'rage' over and over again."
+
+# Marks the end of a stage's input
+_DONE = object()
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(percentile / 100 * (len(sorted_values) - 1))))]
+
+class Stage:
+    """
+    One stage of a pipeline: a pool of worker threads applying a function to every item of a bounded input queue.
+    The function takes an item's state dict and returns the fields to add to it.
+    Once the queue is full, the previous stage blocks, so a slow stage holds back the stages before it.
+    """
+
+    def __init__(self, name: str, function: Callable[[dict], dict], workers: int = 1, queue_size: int = pipeline_queue_size):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.latencies: List[float] = []
+        self.waits: List[float] = []
+        self.errors = 0
+        self.skipped = 0
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+        self._running = workers
+
+    def put(self, item: dict):
+        item["queued_at"] = time.perf_counter()
+        self.queue.put(item)
+
+    def run_worker(self, output: Callable[[dict], None], close_output: Callable[[], None]):
+        """Process items until the end of the input, closing the output once every worker of the stage is done."""
+        while (item := self.queue.get()) is not _DONE:
+            start = time.perf_counter()
+            with self._lock:
+                self.waits.append(start - item.pop("queued_at"))
+                self.started = self.started or start
+            if item.get("error"):
+                # Failed in an earlier stage, passed on so it is still reported
+                with self._lock:
+                    self.skipped += 1
+                output(item)
+                continue
+            try:
+                item.update(self.function(item))
+            except Exception as e:
+                item["error"] = f"{self.name}: {e}"
+            latency = time.perf_counter() - start
+            metrics.observe("dnd_pipeline_stage_seconds", latency, stage=self.name)
+            with self._lock:
+                self.latencies.append(latency)
+                self.errors += bool(item.get("error"))
+                self.finished = time.perf_counter()
+            output(item)
+        with self._lock:
+            self._running -= 1
+            last = self._running == 0
+        if last:
+            close_output()
+
+    def close(self):
+        for _ in range(self.workers):
+            self.queue.put(_DONE)
+
+    def stats(self) -> dict:
+        """Items processed, errors, throughput over the stage's active time, and latency and queue wait percentiles."""
+        latencies, waits = sorted(self.latencies), sorted(self.waits)
+        active = (self.finished - self.started) if self.started and self.finished else 0.0
+        return {
+            "workers": self.workers,
+            "items": len(latencies),
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "items_per_sec": len(latencies) / active if active else 0.0,
+            "p50_latency": _percentile(latencies, 50),
+            "p95_latency": _percentile(latencies, 95),
+            "p50_queue_wait": _percentile(waits, 50),
+        }
+
+def run_pipeline(items: List[dict], stages: List[Stage]) -> tuple[List[dict], dict]:
+    """
+    Runs items through the stages, each item's state dict passing from stage to stage through their queues.
+    Every stage works on different items at the same time, so throughput approaches that of the slowest stage.
+
+    Args:
+        items (List[dict]): The initial state of each item.
+        stages (List[Stage]): The stages, in order.
+
+    Returns:
+        tuple[List[dict], dict]: The final state of each item, in input order, and the stats of each stage by name.
+    """
+    results: List[Optional[dict]] = [None] * len(items)
+    done = queue.Queue()
+    threads = []
+    for i, stage in enumerate(stages):
+        if i + 1 < len(stages):
+            output, close_output = stages[i + 1].put, stages[i + 1].close
+        else:
+            output, close_output = done.put, lambda: done.put(_DONE)
+        for worker in range(stage.workers):
+            thread = threading.Thread(target=stage.run_worker, args=(output, close_output), name=f"{stage.name}-{worker}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    def feed():
+        for index, item in enumerate(items):
+            # Blocks while the first stage's queue is full
+            stages[0].put({**item, "index": index})
+        stages[0].close()
+
+    threading.Thread(target=feed, name="pipeline-feed", daemon=True).start()
+    while (item := done.get()) is not _DONE:
+        item.pop("queued_at", None)
+        results[item.pop("index")] = item
+    for thread in threads:
+        thread.join()
+    return results, {stage.name: stage.stats() for stage in stages}
+
+def create_stages(system: str = "D&D 5e", workers: Optional[dict] = None, queue_size: int = pipeline_queue_size) -> List[Stage]:
+    """The effect creation, type classification and stat block generation stages of the orchestrator."""
+    workers = {**pipeline_stage_workers, **(workers or {})}
+    return [
+        Stage("effect", lambda item: {"effect": generate_effect(item["scenario"])}, workers["effect"], queue_size),
+        Stage("classify", lambda item: {"dnd_type": classify(item["effect"], system)}, workers["classify"], queue_size),
+        Stage(
+            "generate",
+            lambda item: {"stat_block": generate_stat_block(item["dnd_type"], item["effect"], system).model_dump()},
+            workers["generate"],
+            queue_size,
+        ),
+    ]
+
+def run_scenarios(scenarios: List[str], system: str = "D&D 5e", workers: Optional[dict] = None, queue_size: int = pipeline_queue_size) -> tuple[List[dict], dict]:
+    """Create an effect for every scenario and systematise it, through the staged pipeline."""
+    results, stats = run_pipeline([{"scenario": scenario} for scenario in scenarios], create_stages(system, workers, queue_size))
+    for name, stage_stats in stats.items():
+        print(
+            f"{name:<10} {stage_stats['items']} items, {stage_stats['items_per_sec']:.2f} items/sec, "
+            f"p50 {stage_stats['p50_latency']:.2f}s, p95 {stage_stats['p95_latency']:.2f}s, "
+            f"p50 queue wait {stage_stats['p50_queue_wait']:.2f}s, {stage_stats['errors']} errors"
+        )
+    return results, stats
+
+def read_scenarios(input_path: Path) -> List[str]:
+    """Scenarios from a text file with one per line, or a JSONL file with a "scenario" or "description" per record."""
+    with open(input_path, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if input_path.suffix.lower() == ".jsonl":
+        return [(record.get("scenario") or record["description"]) for record in map(json.loads, lines)]
+    return lines
+
 def main():
-    effect = create_effect(EXAMPLE_TEXT)
-    systematise_magic(effect)
+    parser = argparse.ArgumentParser(description="Create magical effects from scenarios and systematise them.")
+    parser.add_argument("input_path", nargs="?", help="Text file with a scenario per line, or JSONL. Runs the example scenario if omitted")
+    parser.add_argument("--system", default="D&D 5e", help="Target system")
+    parser.add_argument("--output", default=None, help="JSONL file the results are written to")
+    for stage in pipeline_stage_workers:
+        parser.add_argument(f"--{stage}-workers", type=int, default=pipeline_stage_workers[stage], help=f"Worker threads of the {stage} stage")
+    parser.add_argument("--queue-size", type=int, default=pipeline_queue_size, help="Items waiting per stage")
+    args = parser.parse_args()
+
+    if args.input_path is None:
+        effect = create_effect(EXAMPLE_TEXT, stream=True)
+        systematise_magic(effect, system=args.system, stream=True)
+        return
+
+    workers = {stage: getattr(args, f"{stage}_workers") for stage in pipeline_stage_workers}
+    results, _ = run_scenarios(read_scenarios(Path(args.input_path)), args.system, workers, args.queue_size)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(result) + "\n" for result in results)
+    else:
+        for result in results:
+            print(json.dumps(result, indent=2))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,231 @@
+import atexit
+import csv
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, Optional
+from config import (
+    dnd_converter_outputs_name,
+    output_store_backend,
+    output_store_path,
+    output_store_flush_every,
+    output_store_flush_interval_seconds,
+)
+
+def format_dnd_type(dnd_type: str) -> str:
+    """File name form of a D&D type, e.g. 'Magic Item' -> 'magic_item'."""
+    return dnd_type.lower().replace(" ", "_")
+
+def to_csv_value(value: Any) -> str:
+    """Format a value the way the output CSVs always have: empty for None, str() for everything else."""
+    return "" if value is None else str(value)
+
+class OutputStore:
+    """
+    Buffered store of converted entities, shared by every worker in the process.
+
+    append() only buffers the row. Rows are written in one batch once flush_every rows are buffered,
+    flush_interval_seconds have passed since the oldest buffered row, or flush() is called.
+    Listeners added with add_flush_listener are called with the rows of each flush, once they are written.
+    Rows are written and listeners called without holding the buffer lock, so listeners can read the store.
+    """
+
+    def __init__(self, flush_every: int = output_store_flush_every, flush_interval_seconds: float = output_store_flush_interval_seconds):
+        self.flush_every = flush_every
+        self.flush_interval_seconds = flush_interval_seconds
+        self._buffer: List[dict] = []
+        self._buffer_started = 0.0
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._flush_listeners: List[Callable[[List[dict]], None]] = []
+        atexit.register(self.flush)
+
+    def add_flush_listener(self, listener: Callable[[List[dict]], None]):
+        self._flush_listeners.append(listener)
+
+    def remove_flush_listener(self, listener: Callable[[List[dict]], None]):
+        self._flush_listeners.remove(listener)
+
+    def append(self, data: dict):
+        """Buffer a row of data, flushing the buffer if it is full or old enough."""
+        with self._lock:
+            if not self._buffer:
+                self._buffer_started = time.monotonic()
+            self._buffer.append(data)
+            if len(self._buffer) < self.flush_every and time.monotonic() - self._buffer_started < self.flush_interval_seconds:
+                return
+            rows, self._buffer = self._buffer, []
+        self._write_and_notify(rows)
+
+    def flush(self):
+        """Write every buffered row, then pass the written rows to the flush listeners."""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if rows:
+            self._write_and_notify(rows)
+
+    def _write_and_notify(self, rows: List[dict]):
+        # Listeners, e.g. the retriever refresh, take their own locks and read the store,
+        # so calling them while holding the buffer lock would deadlock with readers holding those locks
+        with self._write_lock:
+            self._write_rows(rows)
+        for listener in list(self._flush_listeners):
+            try:
+                listener(rows)
+            except Exception as e:
+                print(f"Error notifying output listener: {e}")
+
+    def _write_rows(self, rows: List[dict]):
+        raise NotImplementedError
+
+    def read_rows(self, dnd_type: str, start: int = 0, columns: Optional[List[str]] = None) -> List[dict]:
+        """
+        Reads stored rows for a D&D type, in the order they were written.
+
+        Args:
+            dnd_type (str): The D&D type, e.g. 'Magic Item'.
+            start (int): Number of rows to skip, so readers can load only rows they have not seen yet. Defaults to 0.
+            columns (Optional[List[str]]): Columns to load. Defaults to all columns.
+
+        Returns:
+            List[dict]: The rows, one dict of column values per row.
+        """
+        raise NotImplementedError
+
+    def export_csv(self, dnd_type: str, path: Optional[str | Path] = None) -> Path:
+        """Export every row of a D&D type to a CSV file, by default the per-type outputs CSV."""
+        path = Path(path) if path else Path(f"{dnd_converter_outputs_name}_{format_dnd_type(dnd_type)}.csv")
+        rows = self.read_rows(dnd_type)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if rows:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+                writer.writeheader()
+                writer.writerows({key: to_csv_value(value) for key, value in row.items()} for row in rows)
+        return path
+
+class CSVOutputStore(OutputStore):
+    """Output store writing one CSV per D&D type, the original output format."""
+
+    def _path(self, dnd_type: str) -> Path:
+        return Path(f"{dnd_converter_outputs_name}_{format_dnd_type(dnd_type)}.csv")
+
+    def _write_rows(self, rows: List[dict]):
+        by_type = {}
+        for row in rows:
+            by_type.setdefault(row["dnd_type"], []).append(row)
+        for dnd_type, type_rows in by_type.items():
+            path = self._path(dnd_type)
+            write_header = not path.exists() or path.stat().st_size == 0
+            with open(path, "a", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(type_rows[0]))
+                if write_header:
+                    writer.writeheader()
+                writer.writerows({key: to_csv_value(value) for key, value in row.items()} for row in type_rows)
+
+    def read_rows(self, dnd_type: str, start: int = 0, columns: Optional[List[str]] = None) -> List[dict]:
+        path = self._path(dnd_type)
+        if not path.exists() or path.stat().st_size == 0:
+            return []
+        with open(path, encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))[start:]
+        if columns:
+            rows = [{column: row.get(column) for column in columns} for row in rows]
+        return rows
+
+class SQLiteOutputStore(OutputStore):
+    """
+    Output store writing every D&D type to one SQLite table, with the structured stat block stored as JSON.
+    SQLite serialises writers, so several processes can append to the same store safely.
+    Existing per-type CSVs are imported the first time the store is created.
+    """
+
+    def __init__(self, path: str | Path = output_store_path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        is_new = not self.path.exists()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        # Guards the shared connection only, so appends to the buffer never wait on a write or read
+        self._connection_lock = threading.Lock()
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS outputs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dnd_type TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS outputs_dnd_type ON outputs (dnd_type, id);
+            """
+        )
+        self._connection.commit()
+        if is_new:
+            self._import_csv_outputs()
+
+    def _import_csv_outputs(self):
+        for path in sorted(Path(".").glob(f"{dnd_converter_outputs_name}_*.csv")):
+            with open(path, encoding="utf-8", newline="") as f:
+                rows = [{key: value if value != "" else None for key, value in row.items()} for row in csv.DictReader(f)]
+            if rows:
+                print(f"Importing {len(rows)} rows from {path}...")
+                self._write_rows(rows)
+
+    def _write_rows(self, rows: Iterable[dict]):
+        with self._connection_lock:
+            self._connection.executemany(
+                "INSERT INTO outputs (dnd_type, data) VALUES (?, ?)",
+                [(row["dnd_type"], json.dumps(row)) for row in rows],
+            )
+            self._connection.commit()
+
+    def read_rows(self, dnd_type: str, start: int = 0, columns: Optional[List[str]] = None) -> List[dict]:
+        if columns:
+            # Only the selected columns are extracted from the stored JSON, quoted so lists and strings decode unambiguously
+            selected = ", ".join("json_quote(json_extract(data, ?))" for _ in columns)
+            params = [f'$."{column}"' for column in columns]
+        else:
+            selected, params = "data", []
+        with self._connection_lock:
+            cursor = self._connection.execute(
+                f"SELECT {selected} FROM outputs WHERE dnd_type = ? ORDER BY id LIMIT -1 OFFSET ?",
+                [*params, dnd_type, start],
+            )
+            results = cursor.fetchall()
+        if not columns:
+            return [json.loads(data) for (data,) in results]
+        return [{column: json.loads(value) for column, value in zip(columns, row)} for row in results]
+
+def create_output_store(backend: str = output_store_backend) -> OutputStore:
+    """
+    Creates the output store.
+
+    Args:
+        backend (str): "sqlite" stores every type in one SQLite file, "csv" writes one CSV per type.
+            Defaults to config.output_store_backend.
+    """
+    if backend == "sqlite":
+        return SQLiteOutputStore()
+    if backend == "csv":
+        return CSVOutputStore()
+    raise ValueError(f"Unknown output store backend: {backend}")
+
+_output_store = None
+_output_store_lock = threading.Lock()
+_output_flush_listeners: List[Callable[[List[dict]], None]] = []
+
+def get_output_store() -> OutputStore:
+    """The output store shared by the whole process, created on first use."""
+    global _output_store
+    with _output_store_lock:
+        if _output_store is None:
+            _output_store = create_output_store()
+            for listener in _output_flush_listeners:
+                _output_store.add_flush_listener(listener)
+        return _output_store
+
+def add_output_flush_listener(listener: Callable[[List[dict]], None]):
+    """Add a flush listener to the shared output store, without creating the store before it is needed."""
+    with _output_store_lock:
+        _output_flush_listeners.append(listener)
+        if _output_store is not None:
+            _output_store.add_flush_listener(listener)
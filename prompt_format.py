@@ -0,0 +1,86 @@
+from functools import lru_cache
+from typing import Any, Iterable, Optional
+from pydantic import BaseModel
+from config import llm_provider, openai_llm, prompt_examples_token_budget
+from metrics import metrics
+
+@lru_cache
+def _encoding():
+    """The tokenizer of the OpenAI model, None for other providers or when tiktoken or its vocabulary is unavailable."""
+    if llm_provider != "openai":
+        return None
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(openai_llm)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # tiktoken downloads its vocabulary on first use, which fails offline
+        print(f"tiktoken unavailable, estimating token counts: {e}")
+        return None
+
+def count_tokens(text: str) -> int:
+    """Tokens of a text, counted with tiktoken for OpenAI models, otherwise estimated at four characters per token."""
+    encoding = _encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """The start of a text, at most max_tokens long."""
+    encoding = _encoding()
+    if encoding is None:
+        return text if len(text) <= max_tokens * 4 else text[:max(max_tokens * 4 - 3, 0)] + "..."
+    tokens = encoding.encode(text, disallowed_special=())
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max(max_tokens - 1, 0)]) + "..."
+
+def _format_value(value: Any) -> str:
+    if isinstance(value, (list, tuple)):
+        return ", ".join(_format_value(item) for item in value)
+    # Newlines would break the one field per line layout
+    return " ".join(str(value).split())
+
+def format_stat_block(stat_block: Any) -> str:
+    """
+    A stat block as "field: value" lines, without empty fields, instead of its repr.
+    e.g. "name: Flame Tongue\\ndamage: 2d6 fire\\nrarity: Rare" rather than "DnDItem(name='Flame Tongue', damage='2d6 fire', range=None, ..."
+    """
+    data = stat_block.model_dump() if isinstance(stat_block, BaseModel) else stat_block
+    if not isinstance(data, dict):
+        return str(stat_block)
+    return "\n".join(f"{key}: {_format_value(value)}" for key, value in data.items() if value not in (None, "", []))
+
+def format_examples(examples: Iterable[Any], budget: int = prompt_examples_token_budget) -> str:
+    """
+    Examples formatted with format_stat_block, most similar first, keeping as many as fit in the token budget.
+    The least similar examples are dropped, and the first is truncated if it alone is over the budget.
+    """
+    blocks, used = [], 0
+    for example in examples:
+        block = format_stat_block(example)
+        tokens = count_tokens(block) + (1 if blocks else 0)
+        if used + tokens > budget:
+            if not blocks:
+                blocks.append(truncate_to_tokens(block, budget))
+            metrics.inc("dnd_prompt_examples_trimmed_total")
+            break
+        blocks.append(block)
+        used += tokens
+    return "\n\n".join(blocks)
+
+def record_tokens_saved(prompt: str, original: str, compact: str) -> int:
+    """Record the tokens saved by the compact text of a prompt part, compared to the repr it replaces."""
+    saved = count_tokens(original) - count_tokens(compact)
+    metrics.inc("dnd_prompt_tokens_saved_total", max(saved, 0), prompt=prompt)
+    return saved
+
+def examples_prompt(examples: Optional[list], prompt: str, budget: int = prompt_examples_token_budget) -> tuple[str, int]:
+    """The compact examples for a prompt, and the tokens saved compared to the list's repr."""
+    text = format_examples(examples or [], budget)
+    return text, record_tokens_saved(prompt, str(examples), text)
+
+def stat_block_prompt(stat_block: Any, prompt: str) -> tuple[str, int]:
+    """The compact stat block for a prompt, and the tokens saved compared to its repr."""
+    text = format_stat_block(stat_block)
+    return text, record_tokens_saved(prompt, str(stat_block), text)
@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, Iterator, List, Literal, Optional, Union, get_args, get_origin
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from pydantic import BaseModel
+from config import (
+    llm_provider,
+    model_routes,
+    ollama_llm,
+    openai_llm,
+    embedding_provider,
+    openai_embedding_model,
+    ollama_embedding_model,
+    embedding_batch_sizes,
+    fake_llm_latency_seconds,
+    fake_embedding_dim,
+    fake_embedding_latency_seconds,
+)
+
+def _seed(*parts: str) -> int:
+    return int.from_bytes(hashlib.sha256("\n".join(parts).encode("utf-8")).digest()[:8], "big")
+
+def _fake_value(annotation: Any, name: str, seed: int) -> Any:
+    """A valid value for a field annotation, chosen deterministically from the seed."""
+    origin = get_origin(annotation)
+    if origin is Union:
+        # Optional fields get a value, other unions pick one of their members
+        members = [arg for arg in get_args(annotation) if arg is not type(None)]
+        return _fake_value(members[seed % len(members)], name, seed // len(members))
+    if origin is Literal:
+        values = get_args(annotation)
+        return values[seed % len(values)]
+    if origin is list:
+        inner = get_args(annotation)[0] if get_args(annotation) else str
+        return [_fake_value(inner, name, seed // (i + 1)) for i in range(1 + seed % 2)]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return fake_structured_output(annotation, str(seed))
+    if annotation is int:
+        return 1 + seed % 9
+    if annotation is float:
+        return (seed % 1000) / 100
+    if annotation is bool:
+        return bool(seed % 2)
+    return f"{name.replace('_', ' ')} {seed % 10000}"
+
+def fake_structured_output(output_format: type[BaseModel], prompt: str) -> BaseModel:
+    """A valid instance of a pydantic model, the same for the same model and prompt."""
+    data = {
+        name: _fake_value(field.annotation, name, _seed(output_format.__name__, name, prompt))
+        for name, field in output_format.model_fields.items()
+    }
+    return output_format.model_validate(data)
+
+def fake_text(prompt: str) -> str:
+    """A deterministic free-text response to a prompt."""
+    return f"A fake magical effect, number {_seed(prompt) % 10000}, shimmers into being."
+
+def fake_token_counts(prompt: str, response: str) -> tuple[int, int]:
+    """Rough token counts, about four characters per token, so fake calls still produce token metrics."""
+    return max(1, len(prompt) // 4), max(1, len(response) // 4)
+
+class FakeLLM:
+    """
+    Deterministic, offline stand-in for the OpenAI and Ollama APIs.
+    Returns valid structured outputs for any pydantic model, after latency_seconds, so benchmarks measure the code around the LLM.
+    """
+
+    def __init__(self, latency_seconds: float = fake_llm_latency_seconds, chunk_size: int = 8):
+        self.latency_seconds = latency_seconds
+        self.chunk_size = chunk_size
+
+    def call(self, prompt: str, output_format: Optional[type[BaseModel]] = None):
+        """Respond to a prompt, with an instance of output_format or free text."""
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return fake_structured_output(output_format, prompt) if output_format else fake_text(prompt)
+
+    async def acall(self, prompt: str, output_format: Optional[type[BaseModel]] = None):
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return fake_structured_output(output_format, prompt) if output_format else fake_text(prompt)
+
+    def stream(self, prompt: str, output_format: Optional[type[BaseModel]] = None) -> Iterator[str]:
+        """Stream the response text in chunks, the JSON of the structured output for structured prompts."""
+        response = self.call(prompt, output_format)
+        text = response.model_dump_json() if output_format else response
+        for i in range(0, len(text), self.chunk_size):
+            yield text[i:i + self.chunk_size]
+
+_fake_llm = None
+
+def get_fake_llm() -> FakeLLM:
+    global _fake_llm
+    if _fake_llm is None:
+        _fake_llm = FakeLLM()
+    return _fake_llm
+
+def create_chat_model(provider: str = llm_provider, model: Optional[str] = None, **kwargs):
+    """
+    Creates a LangChain chat model of the agent graph. Only the chosen provider's integration is imported.
+
+    Args:
+        provider (str): "openai", "ollama" or "fake". Defaults to config.llm_provider.
+        model (Optional[str]): The model name. Defaults to the provider's model in config.
+        **kwargs: Passed to the chat model, e.g. cache and callbacks.
+    """
+    from llm_tools import get_http_client, http_limits
+    if provider == "openai":
+        from langchain_openai import ChatOpenAI
+        # stream_usage keeps token counts when the graph is streamed, the HTTP pool is shared with call_llm
+        # Retries are made by the resilience layer around the graph's models
+        return ChatOpenAI(
+            model=model or openai_llm, temperature=0, stream_usage=True, http_client=get_http_client(), max_retries=0, **kwargs
+        )
+    if provider == "ollama":
+        from langchain_ollama import ChatOllama
+        return ChatOllama(model=model or ollama_llm, temperature=0, client_kwargs={"limits": http_limits()}, **kwargs)
+    if provider == "fake":
+        return FakeChatModel(latency_seconds=fake_llm_latency_seconds, model_name=model or "fake", **kwargs)
+    raise ValueError(f"Unknown LLM provider: {provider}")
+
+def route_models(route: str) -> List[tuple[str, str]]:
+    """
+    The (provider, model) of a graph route in config.model_routes, followed by its fallback if it has a different one.
+    With the fake provider every route uses the fake model, so offline runs never reach a real provider.
+    """
+    if llm_provider == "fake":
+        return [("fake", "fake")]
+    models = []
+    for spec in model_routes.get(route, (None, None)):
+        provider, _, model = (spec or llm_provider).partition(":")
+        provider_model = (provider, model or {"openai": openai_llm, "ollama": ollama_llm}.get(provider, ""))
+        if provider_model not in models:
+            models.append(provider_model)
+    return models
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic, offline chat model, supporting with_structured_output for any pydantic model."""
+    latency_seconds: float = 0.0
+    model_name: str = "fake"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _respond(self, messages: list, schema: Optional[type[BaseModel]]) -> AIMessage:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        prompt = "\n".join(str(message.content) for message in messages)
+        content = fake_structured_output(schema, prompt).model_dump_json() if schema else fake_text(prompt)
+        input_tokens, output_tokens = fake_token_counts(prompt, content)
+        return AIMessage(
+            content=content,
+            usage_metadata={"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, fake_schema=None, **kwargs) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=self._respond(messages, fake_schema))])
+
+    def _stream(self, messages, stop=None, run_manager=None, fake_schema=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        message = self._respond(messages, fake_schema)
+        for i in range(0, len(message.content), 8):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=message.content[i:i + 8]))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=message.usage_metadata))
+
+    def with_structured_output(self, schema, **kwargs):
+        # The schema is bound as a model kwarg, so it is part of the cache key, and the response is its JSON
+        return self.bind(fake_schema=schema) | RunnableLambda(lambda message: schema.model_validate_json(message.content))
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic, offline embedding model. Words are hashed into a fixed number of dimensions,
+    so texts sharing words get similar vectors and retrieval results stay meaningful.
+    """
+
+    def __init__(self, dim: int = fake_embedding_dim, latency_seconds: float = fake_embedding_latency_seconds):
+        self.dim = dim
+        self.latency_seconds = latency_seconds
+        self.model = f"fake-{dim}"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            seed = _seed(word)
+            vector[seed % self.dim] += 1.0 if (seed >> 32) % 2 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with deduplication, batching and the content-hash embedding cache.
+    Identical texts are embedded once, cached texts are not sent at all, and the rest are sent in batches of batch_size.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, batch_size: int, cache=None):
+        from embedding_cache import embedding_cache
+        self.embeddings = embeddings
+        self.model = model
+        self.batch_size = batch_size
+        self.cache = cache or embedding_cache
+
+    def _embed(self, texts: List[str], embed_batch, kind: str) -> List[List[float]]:
+        from embedding_cache import embedding_key
+        from metrics import metrics
+        keys = {text: embedding_key(self.model, text, kind) for text in texts}
+        found = self.cache.get_many(list(keys.values()))
+        missing = [text for text, key in keys.items() if key not in found]
+        metrics.inc("dnd_embedding_cache_total", len(keys) - len(missing), result="hit")
+        metrics.inc("dnd_embedding_cache_total", len(missing), result="miss")
+        new_embeddings = {}
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            new_embeddings.update({keys[text]: vector for text, vector in zip(batch, embed_batch(batch))})
+        self.cache.set_many(new_embeddings)
+        found.update(new_embeddings)
+        return [found[keys[text]] for text in texts]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, self.embeddings.embed_documents, "document")
+
+    def embed_query(self, text: str) -> List[float]:
+        # Some providers embed queries differently from documents, so queries go through embed_query
+        # and are cached under their own keys
+        return self._embed([text], lambda batch: [self.embeddings.embed_query(batch[0])], "query")[0]
+
+def create_embeddings(provider: str = embedding_provider, cached: bool = True) -> Embeddings:
+    """
+    Creates the embedding model for documents and queries. Only the chosen provider's integration is imported.
+
+    Args:
+        provider (str): "openai", "ollama" or "fake". Defaults to config.embedding_provider.
+        cached (bool): Wrap the model with deduplication, batching and the embedding cache. Defaults to True.
+    """
+    if provider == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings(model=openai_embedding_model)
+    elif provider == "ollama":
+        from langchain_ollama import OllamaEmbeddings
+        embeddings = OllamaEmbeddings(model=ollama_embedding_model)
+    elif provider == "fake":
+        embeddings = FakeEmbeddings()
+    else:
+        raise ValueError(f"Unknown embedding provider: {provider}")
+    if not cached:
+        return embeddings
+    return CachedEmbeddings(embeddings, model=embeddings.model, batch_size=embedding_batch_sizes.get(provider, 100))
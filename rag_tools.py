@@ -1,57 +1,202 @@
 from dotenv import load_dotenv
-from langchain_community.document_loaders import CSVLoader
-from config import dnd_converter_outputs_name
+from config import dnd_converter_outputs_name, output_store_backend, vector_search_mode, vector_index_mmap, vector_search_nprobe
 from pathlib import Path
-from langchain_core.vectorstores import InMemoryVectorStore
-from langchain_openai import OpenAIEmbeddings
-from langchain.tools.retriever import create_retriever_tool
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
 from dnd_classes import DND_MAP
-from typing import Literal, List, Union, get_origin, get_args
+from vector_index import VectorIndex, content_hash
+from output_store import add_output_flush_listener, format_dnd_type, get_output_store, to_csv_value
+from metrics import metrics
+from typing import Any, Callable, Literal, List, Optional, Union, get_origin, get_args
+from functools import lru_cache
 import re
+import threading
 
 load_dotenv()
 
-def ingest_documents(dnd_type: str = "magic_item") -> list | None:
+# Retriever shared by every graph run in this process, and its retriever tools keyed by D&D type
+_index_retriever = None
+_retriever_tools: dict[str, Any] = {}
+_retriever_registry_lock = threading.RLock()
+# Held while the retriever is built or its index updated, never while holding _retriever_registry_lock,
+# so readers of the registry do not wait for the output store
+_retriever_build_lock = threading.RLock()
+
+# Row fields stored as filterable metadata in the vector index
+FILTER_FIELDS = ("dnd_type", "dnd_system", "rarity", "spell_level", "magic_school")
+
+# D&D types by their file name form, e.g. 'magic_item' -> 'Magic Item'
+DND_TYPES = {format_dnd_type(dnd_type): dnd_type for dnd_type in DND_MAP}
+
+def ingest_documents(dnd_type: str = "magic_item", start: int = 0, columns: List[str] | None = None) -> list | None:
     """
-    Ingests documents from a CSV file for a specified D&D type.
+    Ingests documents from the output store for a specified D&D type.
+    Each document holds one "column: value" line per column, the same text the output CSVs were loaded as,
+    and keeps the stored row in its "data" metadata so retrieval can build typed objects without reparsing the text.
     
     Args:
         dnd_type (str): The type of D&D content to ingest. Defaults to "magic_item".
+        start (int): Number of stored rows to skip, to ingest only rows added since a previous call. Defaults to 0.
+        columns (List[str] | None): Columns to load. Defaults to all columns.
     
     Returns:
-        list | None: A list of loaded documents if successful, None if the file doesn't exist,
-                     is empty, or contains no valid documents.
+        list | None: A list of loaded documents if successful, None if there are no (new) rows.
     """
     print(f"Ingesting documents for DnD type: {dnd_type}...")
-    # Load the CSV file
-    csv_file_path = Path(f"{dnd_converter_outputs_name}_{dnd_type}.csv")
-    
-    # Check if file exists and is not empty
-    if not csv_file_path.exists() or csv_file_path.stat().st_size == 0:
+    rows = get_output_store().read_rows(DND_TYPES.get(dnd_type, dnd_type), start=start, columns=columns)
+    if not rows:
         return None
     
-    loader = CSVLoader(file_path=csv_file_path, encoding="utf-8")
-    
-    # Load documents from the CSV file
-    documents = loader.load()
-    
-    # # Print the loaded documents
-    # for doc in documents:
-    #     print(doc.page_content)
-    #     print("Metadata:", doc.metadata)
-    #     print("-" * 40)  # Separator for readability
+    return [
+        Document(
+            page_content="\n".join(f"{key}: {to_csv_value(value).strip()}" for key, value in row.items()),
+            metadata={"source": output_store_backend, "row": start + i, "data": row},
+        )
+        for i, row in enumerate(rows)
+    ]
+
+def embed_queries(embeddings: Embeddings, queries: List[str]) -> List[List[float]]:
+    """Embed search queries, in one request for more than one, recording the embedding metrics."""
+    metrics.inc("dnd_embeddings_total", len(queries), kind="query")
+    with metrics.timer("dnd_embedding_seconds", event="embedding", kind="query"):
+        if len(queries) == 1:
+            return [embeddings.embed_query(queries[0])]
+        return embeddings.embed_documents(queries)
+
+def embed_documents(embeddings: Embeddings, texts: List[str]) -> List[List[float]]:
+    """Embed documents, recording the embedding metrics."""
+    metrics.inc("dnd_embeddings_total", len(texts), kind="document")
+    with metrics.timer("dnd_embedding_seconds", event="embedding", kind="document"):
+        return embeddings.embed_documents(texts)
+
+@lru_cache(maxsize=None)
+def get_embeddings() -> Embeddings:
+    """The configured embedding model, shared by document ingestion and queries, imported on first use."""
+    from providers import create_embeddings
+    return create_embeddings()
+
+def filter_metadata(row: dict) -> dict:
+    """The filterable metadata of a stored row, the FILTER_FIELDS it has a value for."""
+    return {field: row[field] for field in FILTER_FIELDS if row.get(field) not in (None, "")}
+
+class IndexRetriever(BaseRetriever):
+    """Retriever that embeds the query and searches the persistent VectorIndex of every D&D type."""
+    index: VectorIndex
+    documents: dict[str, Document]
+    embeddings: Embeddings
+    k: int = 2
+    rows: dict[str, int] = {} # Stored rows loaded so far per D&D type, so refreshes only ingest new ones
+    filter: Optional[dict[str, Any]] = None # Metadata filter applied to every search, e.g. {"dnd_type": "Spell"}
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.search_documents(query, self.k)
+
+    def search_documents(self, query: str, k: int, filter: Optional[dict[str, Any]] = None) -> List[Document]:
+        """The k documents most similar to the query, among those matching the filter."""
+        return self.search_embedding(embed_queries(self.embeddings, [query])[0], k, filter)
+
+    def search_embedding(self, query_embedding: List[float], k: int, filter: Optional[dict[str, Any]] = None) -> List[Document]:
+        """The k documents most similar to an already embedded query, among those matching the filter."""
+        filter = {**(self.filter or {}), **(filter or {})}
+        # Rows removed from the output store stay in the append-only index, so search past them
+        stale = max(len(self.index) - len(self.documents), 0)
+        results = self.index.search(query_embedding, k=k + stale, filter=filter or None)
+        return [self.documents[text_hash] for text_hash, _ in results if text_hash in self.documents][:k]
+
+    def for_type(self, dnd_type: str) -> "IndexRetriever":
+        """A retriever sharing this one's index and documents, searching only the stored objects of a D&D type."""
+        # A shallow copy, so documents added by refresh_retriever are visible to both
+        return self.model_copy(update={"filter": {**(self.filter or {}), "dnd_type": dnd_type}})
+
+    def type_rows(self, dnd_type: str) -> int:
+        return self.rows.get(format_dnd_type(dnd_type), 0)
+
+def get_index_path() -> Path:
+    """Path prefix of the on-disk vector index shared by every D&D type, stored next to the outputs."""
+    return Path(f"{dnd_converter_outputs_name}_index")
+
+def update_index(index: VectorIndex, documents: list, embeddings: Embeddings) -> dict[str, Document]:
+    """
+    Embeds documents that are not yet in the index and appends them to it, with their filterable metadata.
+
+    Args:
+        index (VectorIndex): The index to update.
+        documents (list): The documents to index.
+        embeddings (Embeddings): The embedding model used for new documents.
+
+    Returns:
+        dict[str, Document]: The documents keyed by content hash.
+    """
+    documents_by_hash = {content_hash(doc.page_content): doc for doc in documents}
+    new_hashes = [text_hash for text_hash in documents_by_hash if text_hash not in index]
+    if new_hashes:
+        print(f"Embedding {len(new_hashes)} new documents...")
+        new_documents = [documents_by_hash[text_hash] for text_hash in new_hashes]
+        new_embeddings = embed_documents(embeddings, [doc.page_content for doc in new_documents])
+        index.add(new_hashes, new_embeddings, [filter_metadata(doc.metadata["data"]) for doc in new_documents])
+    return documents_by_hash
+
+def create_vector_index(documents: list, embeddings: Embeddings) -> tuple[VectorIndex, dict[str, Document]]:
+    """
+    Loads the persistent vector index of every D&D type and brings it up to date with the documents.
+
+    Returns:
+        tuple[VectorIndex, dict[str, Document]]: The index and the documents keyed by content hash.
+    """
+    print("Loading vector index for documents...")
+    index = VectorIndex(
+        get_index_path(),
+        model=embeddings.model,
+        mode=vector_search_mode,
+        mmap=vector_index_mmap,
+        nprobe=vector_search_nprobe,
+    )
+    documents_by_hash = update_index(index, documents, embeddings)
+    return index, documents_by_hash
 
-    return documents
+def ingest_all_documents() -> tuple[list, dict[str, int]]:
+    """Ingests the stored rows of every D&D type, returning the documents and the number of rows per type."""
+    documents, rows = [], {}
+    for dnd_type_formatted in DND_TYPES:
+        type_documents = ingest_documents(dnd_type=dnd_type_formatted) or []
+        documents.extend(type_documents)
+        rows[dnd_type_formatted] = len(type_documents)
+    return documents, rows
 
-def create_vector_store(documents: list) -> InMemoryVectorStore:
-    print("Creating vector store from documents...")
-    # Create an in-memory vector store
-    vector_store = InMemoryVectorStore.from_documents(documents=documents, embedding=OpenAIEmbeddings())    
-    return vector_store
+def index_documents(dnd_type: str | None = None):
+    """Embed any stored rows that are not yet in the vector index, for a D&D type or for every type."""
+    if dnd_type is None:
+        documents, _ = ingest_all_documents()
+    else:
+        documents = ingest_documents(dnd_type=format_dnd_type(dnd_type))
+    if documents:
+        create_vector_index(documents, get_embeddings())
+
+def create_index_retriever(number_to_retrieve: int = 2) -> IndexRetriever | None:
+    """
+    Index retriever for every dnd type, backed by one persistent vector index.
+
+    Returns:
+        IndexRetriever | None: The retriever if documents are available, None if no documents found.
+    """
+    # Ingest the documents of every type from the output store
+    documents, rows = ingest_all_documents()
+    
+    # Handle the case where no documents are available
+    if not documents:
+        print("No documents available for any DnD type. Cannot create retriever.")
+        return None
+    
+    # Load the persistent vector index, embedding only documents it has not seen yet
+    embeddings = get_embeddings()
+    index, documents_by_hash = create_vector_index(documents, embeddings)
+    return IndexRetriever(index=index, documents=documents_by_hash, embeddings=embeddings, k=number_to_retrieve, rows=rows)
 
 def create_retriever(dnd_type: str = 'Magic Item', number_to_retrieve: int = 2):
     """
-    Retriever for single dnd type. 
+    Retriever for single dnd type, searching the shared index filtered to the type.
     Note that it will always retrieve number_to_retrieve documents, as long as they are available.
     Documents are separated by "\n--document-separator--\n" 
     
@@ -64,34 +209,193 @@ def create_retriever(dnd_type: str = 'Magic Item', number_to_retrieve: int = 2):
     """
 
     print(f"Creating retriever for DnD type: {dnd_type}...")
-    # Process dnd type
-    dnd_type_formatted = dnd_type.lower().replace(" ", "_")
-    
-    # Ingest documents from the CSV file
-    documents = ingest_documents(dnd_type=dnd_type_formatted)
-    
-    # Handle the case where no documents are available
-    if documents is None:
+    index_retriever = create_index_retriever(number_to_retrieve=number_to_retrieve)
+    if index_retriever is None or not index_retriever.type_rows(dnd_type):
         print(f"No documents available for DnD type: {dnd_type}. Cannot create retriever.")
         return None
     
-    # Create a vector store from the documents
-    vector_store = create_vector_store(documents)
-    
-    # Create a retriever tool from the vector store
-    retriever_tool = create_retriever_tool(
-        vector_store.as_retriever(search_kwargs={"k": number_to_retrieve}),
+    # Create a retriever tool from the vector index
+    return _create_retriever_tool(index_retriever.for_type(dnd_type), dnd_type)
+
+def _create_retriever_tool(index_retriever: IndexRetriever, dnd_type: str):
+    from langchain.tools.retriever import create_retriever_tool
+    dnd_type_formatted = dnd_type.lower().replace(" ", "_")
+    return create_retriever_tool(
+        index_retriever,
         f"{dnd_type_formatted}_retriever",
         f"Retriever for {dnd_type} examples",
         document_separator = "\n--document-separator--\n"
     )
 
-    return retriever_tool
+def get_index_retriever() -> IndexRetriever | None:
+    """
+    The long-lived IndexRetriever over every D&D type, creating it on first use.
+    The one index is shared by every graph run in the process, refresh_retriever keeps it up to date.
+
+    Returns:
+        IndexRetriever | None: The cached retriever, None if no documents found.
+    """
+    global _index_retriever
+    if _index_retriever is not None:
+        return _index_retriever
+    with _retriever_build_lock:
+        if _index_retriever is not None:
+            return _index_retriever
+        print("Creating retriever for every DnD type...")
+        index_retriever = create_index_retriever()
+        with _retriever_registry_lock:
+            if _index_retriever is None:
+                _index_retriever = index_retriever
+            return _index_retriever
+
+def get_retriever(dnd_type: str = 'Magic Item'):
+    """
+    Returns the long-lived retriever tool for a D&D type, creating it on first use.
+    Every tool searches the shared index, filtered to its type.
+    
+    Args:
+        dnd_type (str): The type of D&D content to get the retriever for. Defaults to 'Magic Item'.
+    
+    Returns:
+        retriever_tool | None: The cached retriever tool, None if no documents found.
+    """
+    index_retriever = get_index_retriever()
+    if index_retriever is None or not index_retriever.type_rows(dnd_type):
+        return None
+    with _retriever_registry_lock:
+        if dnd_type not in _retriever_tools:
+            _retriever_tools[dnd_type] = _create_retriever_tool(index_retriever.for_type(dnd_type), dnd_type)
+        return _retriever_tools[dnd_type]
+
+def refresh_retriever(dnd_type: str = 'Magic Item'):
+    """
+    Brings the index and cached retriever up to date after rows of a D&D type were added to the output store.
+    Only the new rows are read and embedded. If no retriever is cached yet, only the index is updated.
+    """
+    with _retriever_build_lock:
+        if _index_retriever is None:
+            index_documents(dnd_type)
+            return
+        dnd_type_formatted = format_dnd_type(dnd_type)
+        documents = ingest_documents(dnd_type=dnd_type_formatted, start=_index_retriever.rows.get(dnd_type_formatted, 0))
+        if documents is not None:
+            # Updated in place, so the per-type retrievers sharing the documents see the new ones
+            _index_retriever.documents.update(update_index(_index_retriever.index, documents, _index_retriever.embeddings))
+            _index_retriever.rows[dnd_type_formatted] = _index_retriever.rows.get(dnd_type_formatted, 0) + len(documents)
+
+def refresh_retrievers_for_rows(rows: List[dict]):
+    """Output store flush listener, refreshing the index with the rows of every D&D type that received new ones."""
+    for dnd_type in dict.fromkeys(row["dnd_type"] for row in rows):
+        try:
+            refresh_retriever(dnd_type)
+        except Exception as e:
+            print(f"Error updating vector index: {e}")
+
+add_output_flush_listener(refresh_retrievers_for_rows)
+
+def _unwrap_optional(field_type: Any) -> Any:
+    # Optional[T] is Union[T, None], get the non-None type
+    if get_origin(field_type) is Union:
+        args = get_args(field_type)
+        if len(args) == 2 and type(None) in args:
+            return args[0] if args[1] is type(None) else args[1]
+    return field_type
+
+def _split_list(value: Any) -> list:
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    # The output CSVs store lists as their Python repr, e.g. "['Verbal', 'Somatic']"
+    value = str(value).strip().removeprefix("[").removesuffix("]")
+    return [v.strip().strip("'\"").strip() for v in value.split(',') if v.strip().strip("'\"").strip()]
+
+def _make_field_converter(field_type: Any) -> Callable[[Any], Any]:
+    """Build the function converting a stored or parsed value to a field's type, from its annotation."""
+    field_type = _unwrap_optional(field_type)
+    origin = get_origin(field_type)
+
+    if field_type is int:
+        def convert(value):
+            if isinstance(value, int):
+                return value
+            # Try to extract number from string
+            number_match = re.search(r'(\d+)', str(value))
+            return int(number_match.group(1)) if number_match else None
+    elif field_type is str:
+        convert = str
+    elif origin is Literal:
+        # Handle Literal types (like saving_throw_type, magic_school)
+        valid_values = frozenset(get_args(field_type))
+        def convert(value):
+            return value if value in valid_values else None
+    elif origin is list:
+        inner_type = _unwrap_optional(get_args(field_type)[0]) if get_args(field_type) else None
+        if get_origin(inner_type) is Literal:
+            # Handle List[Literal[...]] types
+            valid_values = frozenset(get_args(inner_type))
+            def convert(value):
+                return [v for v in _split_list(value) if v in valid_values]
+        else:
+            convert = _split_list
+    else:
+        # Default case - use the value as is
+        def convert(value):
+            return value
+
+    def convert_or_none(value):
+        if value is None or value == "":
+            return None
+        return convert(value)
+    return convert_or_none
+
+@lru_cache(maxsize=None)
+def get_field_converters(item_class: type) -> dict[str, Callable[[Any], Any]]:
+    """
+    Per-field converters for a Pydantic model, built from its annotations once and cached.
+    
+    Args:
+        item_class (type): The Pydantic model class, e.g. DnDItem.
+    
+    Returns:
+        dict[str, Callable[[Any], Any]]: A converter for each field, keyed by field name.
+    """
+    return {name: _make_field_converter(field_info.annotation) for name, field_info in item_class.model_fields.items()}
+
+def to_dnd_object(data: dict, item_class: type):
+    """
+    Converts a stored row (or the fields parsed from a document) to an object of the specified Pydantic model.
+    Keys that don't exist in the model are skipped.
+    
+    Args:
+        data (dict): Column values keyed by column name.
+        item_class (type): The Pydantic model class to create an instance of.
+    
+    Returns:
+        The parsed object, or None if the data does not validate.
+    """
+    converters = get_field_converters(item_class)
+    item_data = {key: converters[key](value) for key, value in data.items() if key in converters}
+    
+    # Create item object - let Pydantic handle validation
+    try:
+        return item_class(**item_data)
+    except Exception as e:
+        print(f"Error creating {item_class.__name__}: {e}")
+        print(f"Item data: {item_data}")
+        return None
+
+def _parse_document_text(doc: str) -> dict:
+    item_data = {}
+    for line in doc.split('\n'):
+        key, separator, value = line.partition(':')
+        if separator:
+            item_data[key.strip()] = value.strip()
+    return item_data
 
 def parse_dnd_objects(text: str, item_class: type) -> List:
     """
     Parse a text containing multiple D&D objects separated by --document-separator--
     and convert them to a list of the specified Pydantic model objects.
+    Prefer retrieve_similar_objects, which builds the objects from the stored rows without any text parsing.
     
     Args:
         text (str): The raw text containing object descriptions
@@ -100,107 +404,94 @@ def parse_dnd_objects(text: str, item_class: type) -> List:
     Returns:
         List: A list of parsed objects of the specified type
     """
-    
-    # Get field information from the Pydantic model
-    fields_info = item_class.model_fields
-    
-    # Split the text by document separator
-    documents = text.split('--document-separator--')
-    
     items = []
-    
-    for doc in documents:
+    for doc in text.split('--document-separator--'):
         doc = doc.strip()
         if not doc:
             continue
-            
-        # Parse each field from the document
-        item_data = {}
-        
-        # Extract each field using regex or line-by-line parsing
-        lines = doc.split('\n')
-        
-        for line in lines:
-            line = line.strip()
-            if ':' in line:
-                key, value = line.split(':', 1)
-                key = key.strip()
-                value = value.strip()
-                
-                # Skip keys that don't exist in the model
-                if key not in fields_info:
-                    continue
-                
-                # Get field info
-                field_info = fields_info[key]
-                field_type = field_info.annotation
-                
-                # Handle Optional types
-                origin = get_origin(field_type)
-                if origin is Union:  # Optional[T] is Union[T, None]
-                    args = get_args(field_type)
-                    if len(args) == 2 and type(None) in args:
-                        # This is Optional[T], get the non-None type
-                        field_type = args[0] if args[1] is type(None) else args[1]
-                        origin = get_origin(field_type)
-                
-                # Convert value based on field type
-                if not value:  # Empty string
-                    item_data[key] = None
-                elif field_type == int:
-                    # Try to extract number from string
-                    number_match = re.search(r'(\d+)', value)
-                    item_data[key] = int(number_match.group(1)) if number_match else None
-                elif field_type == str:
-                    item_data[key] = value
-                elif get_origin(field_type) is Literal:
-                    # Handle Literal types (like saving_throw_type, magic_school)
-                    valid_values = get_args(field_type)
-                    item_data[key] = value if value in valid_values else None
-                elif origin is list:  # Handle List types
-                    # Get the inner type of the List
-                    list_args = get_args(field_type)
-                    if list_args:
-                        inner_type = list_args[0]
-                        
-                        # Split the value by comma or other delimiter
-                        list_values = [v.strip() for v in value.split(',') if v.strip()]
-                        
-                        # Handle List[Literal[...]] types
-                        if get_origin(inner_type) is Literal:
-                            valid_values = get_args(inner_type)
-                            item_data[key] = [v for v in list_values if v in valid_values]
-                        elif inner_type == str:
-                            item_data[key] = list_values
-                        else:
-                            # Default case for other list types
-                            item_data[key] = list_values
-                    else:
-                        # Fallback if no type args found
-                        item_data[key] = [v.strip() for v in value.split(',') if v.strip()]
-                else:
-                    # Default case - try to use the value as is
-                    item_data[key] = value
-        
-        # Create item object - let Pydantic handle validation
-        try:
-            item = item_class(**item_data)
+        item = to_dnd_object(_parse_document_text(doc), item_class)
+        if item is not None:
+            items.append(item)
+    return items
+
+def documents_to_dnd_objects(documents: List[Document], item_class: type) -> List:
+    """Convert retrieved documents to objects of the specified Pydantic model, from their stored rows where available."""
+    items = []
+    for doc in documents:
+        data = doc.metadata.get("data")
+        item = to_dnd_object(data if data is not None else _parse_document_text(doc.page_content), item_class)
+        if item is not None:
             items.append(item)
-        except Exception as e:
-            print(f"Error creating {item_class.__name__}: {e}")
-            print(f"Item data: {item_data}")
-    
     return items
 
-def retrieve_similar_objects(query: str = "Find a magic item with fire damage", dnd_type: str = "Magic Item") -> List:
-    retriever_tool = create_retriever(dnd_type=dnd_type)
-    if retriever_tool is None:
+def retrieve_similar_objects(
+    query: str = "Find a magic item with fire damage",
+    dnd_type: str = "Magic Item",
+    k: int | None = None,
+    filter: dict[str, Any] | None = None,
+) -> List:
+    """
+    Retrieve the stored objects of a D&D type most similar to a query, as objects of the type's Pydantic model.
+    The query can describe an object of another type, e.g. the spells most similar to a magic item's description.
+    
+    Args:
+        query (str): The search query.
+        dnd_type (str): The D&D type to search. Defaults to "Magic Item".
+        k (int | None): Number of objects to retrieve. Defaults to the retriever's k.
+        filter (dict[str, Any] | None): Further metadata filter, on any of FILTER_FIELDS, e.g. {"dnd_system": "D&D 5e", "spell_level": [1, 2]}.
+    
+    Returns:
+        List: The similar objects, None if no documents are available.
+    """
+    index_retriever = get_index_retriever()
+    if index_retriever is None or not index_retriever.type_rows(dnd_type):
         print(f"No documents available for DnD type: {dnd_type}. Cannot retrieve similar items.")
         return None
     
-    result = retriever_tool.invoke({"query": query})
-    parsed_result = parse_dnd_objects(result, DND_MAP[dnd_type])
-    return parsed_result
+    with metrics.timer("dnd_retrieval_seconds", event="retrieval", dnd_type=dnd_type):
+        documents = index_retriever.search_documents(query, k or index_retriever.k, filter={**(filter or {}), "dnd_type": dnd_type})
+        return documents_to_dnd_objects(documents, DND_MAP[dnd_type])
+
+def retrieve_similar_objects_by_type(
+    query: str | dict[str, str],
+    dnd_types: List[str] | None = None,
+    k: int | None = None,
+    filter: dict[str, Any] | None = None,
+) -> dict[str, List]:
+    """
+    Retrieve the stored objects most similar to a query for several D&D types, with a single embedding request.
+    Used when the type of the object is not known yet.
+    
+    Args:
+        query (str | dict[str, str]): The search query, or a query per D&D type.
+        dnd_types (List[str] | None): The D&D types to search. Defaults to the types of the queries, or every type in DND_MAP.
+        k (int | None): Number of objects to retrieve per type. Defaults to the retriever's k.
+        filter (dict[str, Any] | None): Further metadata filter applied to every type, on any of FILTER_FIELDS.
+    
+    Returns:
+        dict[str, List]: The similar objects keyed by D&D type, for the types that have documents.
+    """
+    dnd_types = dnd_types or (list(query) if isinstance(query, dict) else list(DND_MAP))
+    index_retriever = get_index_retriever()
+    dnd_types = [dnd_type for dnd_type in dnd_types if index_retriever is not None and index_retriever.type_rows(dnd_type)]
+    if not dnd_types:
+        print("No documents available for any DnD type. Cannot retrieve similar items.")
+        return {}
+    
+    # One request embeds the queries for every type, each searched in the shared index filtered to its type
+    with metrics.timer("dnd_retrieval_seconds", event="retrieval", dnd_type="any"):
+        if isinstance(query, dict):
+            query_embeddings = dict(zip(dnd_types, embed_queries(index_retriever.embeddings, [query[dnd_type] for dnd_type in dnd_types])))
+        else:
+            query_embedding = embed_queries(index_retriever.embeddings, [query])[0]
+            query_embeddings = {dnd_type: query_embedding for dnd_type in dnd_types}
+        return {
+            dnd_type: documents_to_dnd_objects(
+                index_retriever.search_embedding(query_embeddings[dnd_type], k or index_retriever.k, filter={**(filter or {}), "dnd_type": dnd_type}),
+                DND_MAP[dnd_type],
+            )
+            for dnd_type in dnd_types
+        }
 
 if __name__ == "__main__":
     parsed_result = retrieve_similar_objects(dnd_type="Spell")
@@ -0,0 +1,298 @@
+import asyncio
+import contextvars
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Awaitable, Callable, Optional
+from config import (
+    http_max_connections,
+    llm_timeout_seconds,
+    llm_max_retries,
+    llm_retry_base_delay_seconds,
+    llm_retry_max_delay_seconds,
+    llm_hedging_enabled,
+    llm_hedge_min_delay_seconds,
+    llm_rate_limits,
+)
+from metrics import metrics
+
+# Rate limiting, request timeouts, conflicts and server errors, which may succeed when retried
+TRANSIENT_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def is_unreachable(error: BaseException) -> bool:
+    """
+    Whether the provider could not be connected to at all, e.g. connection refused because the server is down.
+    Provider clients wrap the connection error, e.g. Ollama raises a ConnectionError from it, so its causes are checked too.
+    """
+    httpx = sys.modules.get("httpx")
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, ConnectionRefusedError) or (httpx is not None and isinstance(error, httpx.ConnectError)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether a failed LLM call may succeed if retried: timeouts, dropped connections, rate limiting and server errors.
+    An unreachable provider is not retried, so a route's fallback model takes over at once.
+    """
+    if is_unreachable(error):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in TRANSIENT_STATUS_CODES
+    # Provider errors are only checked for if their library is loaded, so this never imports one
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.APIConnectionError)
+
+class TokenBucket:
+    """
+    Client-side rate limiter allowing rate requests per second on average, in bursts of up to burst requests.
+    Callers reserve a token and wait until it is due, so waiting callers are served in order.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, max_wait: Optional[float] = None) -> float:
+        """
+        Take a token, returning the seconds to wait before using it.
+        Raises TimeoutError, without taking the token, if that is longer than max_wait.
+        """
+        with self._lock:
+            self._refill()
+            wait_seconds = max(0.0, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait_seconds > max_wait:
+                raise TimeoutError(f"Rate limit of {self.rate} requests/sec leaves no slot within {max_wait:.2f}s")
+            self.tokens -= 1
+            return wait_seconds
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available now."""
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+_rate_limiters: dict[str, Optional[TokenBucket]] = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider: str) -> Optional[TokenBucket]:
+    """The rate limiter shared by every call to a provider, None if config.llm_rate_limits does not limit it."""
+    with _rate_limiters_lock:
+        if provider not in _rate_limiters:
+            limit = llm_rate_limits.get(provider)
+            _rate_limiters[provider] = TokenBucket(*limit) if limit else None
+        return _rate_limiters[provider]
+
+def _reserve(provider: str, deadline: float) -> float:
+    limiter = get_rate_limiter(provider)
+    if limiter is None:
+        return 0.0
+    wait_seconds = limiter.reserve(max_wait=deadline - time.monotonic())
+    metrics.observe("dnd_llm_rate_limit_wait_seconds", wait_seconds, provider=provider)
+    return wait_seconds
+
+def _try_acquire(provider: str) -> bool:
+    limiter = get_rate_limiter(provider)
+    return limiter is None or limiter.try_acquire()
+
+class LatencyTracker:
+    """Latencies of the most recent successful calls per model, giving the delay after which a call is hedged."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._latencies: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def add(self, key: str, seconds: float):
+        with self._lock:
+            self._latencies.setdefault(key, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, key: str, percentile: float) -> Optional[float]:
+        """The latency percentile of a model, None until it has min_samples calls."""
+        with self._lock:
+            latencies = sorted(self._latencies.get(key, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(round(percentile / 100 * (len(latencies) - 1))))]
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """The p95 latency of a model, at least llm_hedge_min_delay_seconds. None, for no hedging, until it is known."""
+        p95 = self.percentile(key, 95)
+        return None if p95 is None else max(p95, llm_hedge_min_delay_seconds)
+
+latency_tracker = LatencyTracker()
+
+# Sync calls run on these threads, so the caller can stop waiting at the deadline or when a hedged duplicate answers first.
+# Requests in flight are bounded by the HTTP connection pools, so this is enough threads for every one of them.
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=2 * http_max_connections, thread_name_prefix="llm-call")
+        return _executor
+
+def _submit(call: Callable[[], Any], key: str) -> Future:
+    # Each request runs in a copy of the caller's context, keeping LangChain's callbacks and LangGraph's config
+    context = contextvars.copy_context()
+    start = time.perf_counter()
+
+    def run():
+        result = context.run(call)
+        latency_tracker.add(key, time.perf_counter() - start)
+        return result
+    return _get_executor().submit(run)
+
+def _retry_delay(attempt: int) -> float:
+    # Full jitter, so clients failing together do not retry together
+    return random.uniform(0, min(llm_retry_max_delay_seconds, llm_retry_base_delay_seconds * 2 ** attempt))
+
+def _attempt(call: Callable[[], Any], provider: str, model: str, deadline: float, hedge: bool) -> Any:
+    key = f"{provider}:{model}"
+    time.sleep(_reserve(provider, deadline))
+    primary = _submit(call, key)
+    futures = [primary]
+    hedge_delay = latency_tracker.hedge_delay(key) if hedge else None
+    if hedge_delay is not None and not wait(futures, timeout=min(hedge_delay, max(deadline - time.monotonic(), 0))).done:
+        # A duplicate is only sent if the rate limit has room for it right now
+        if time.monotonic() < deadline and _try_acquire(provider):
+            metrics.inc("dnd_llm_hedges_total", provider=provider, model=model)
+            futures.append(_submit(call, key))
+    while True:
+        done, pending = wait(futures, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            metrics.inc("dnd_llm_timeouts_total", provider=provider, model=model)
+            raise TimeoutError(f"{key} did not respond within the deadline")
+        # The first valid response wins, an error only counts if no other request is still running
+        if successes := [future for future in done if future.exception() is None]:
+            if successes[0] is not primary:
+                metrics.inc("dnd_llm_hedge_wins_total", provider=provider, model=model)
+            return successes[0].result()
+        if not pending:
+            return done.pop().result()
+        futures = list(pending)
+
+def resilient_call(
+    call: Callable[[], Any],
+    provider: str,
+    model: str,
+    timeout: float = llm_timeout_seconds,
+    hedge: bool = llm_hedging_enabled,
+) -> Any:
+    """
+    Make an LLM request with a deadline, jittered exponential retry on transient errors, optional hedging
+    and the provider's client-side rate limit.
+
+    Args:
+        call (Callable[[], Any]): Makes the request and returns the parsed response, raising if it is invalid.
+        provider (str): The provider, whose rate limit applies.
+        model (str): The model, whose recent latencies decide when to hedge.
+        timeout (float): Seconds until the deadline of the call, retries included. Defaults to config.llm_timeout_seconds.
+        hedge (bool): Send a duplicate request once the call is slower than the model's p95 latency,
+            using whichever valid response comes first. Defaults to config.llm_hedging_enabled.
+
+    Returns:
+        Any: The result of call.
+    """
+    deadline = time.monotonic() + timeout
+    for attempt in range(llm_max_retries + 1):
+        try:
+            return _attempt(call, provider, model, deadline, hedge)
+        except Exception as e:
+            delay = _retry_delay(attempt)
+            if attempt == llm_max_retries or not is_transient(e) or delay >= deadline - time.monotonic():
+                raise
+            metrics.inc("dnd_llm_retries_total", provider=provider, model=model)
+            metrics.log("llm_retry", provider=provider, model=model, attempt=attempt + 1, delay_seconds=delay, error=str(e))
+            time.sleep(delay)
+
+async def _atimed(acall: Callable[[], Awaitable], key: str) -> Any:
+    start = time.perf_counter()
+    result = await acall()
+    latency_tracker.add(key, time.perf_counter() - start)
+    return result
+
+async def _aattempt(acall: Callable[[], Awaitable], provider: str, model: str, deadline: float, hedge: bool) -> Any:
+    key = f"{provider}:{model}"
+    await asyncio.sleep(_reserve(provider, deadline))
+    primary = asyncio.ensure_future(_atimed(acall, key))
+    tasks = {primary}
+    try:
+        hedge_delay = latency_tracker.hedge_delay(key) if hedge else None
+        if hedge_delay is not None and not (await asyncio.wait(tasks, timeout=min(hedge_delay, max(deadline - time.monotonic(), 0))))[0]:
+            if time.monotonic() < deadline and _try_acquire(provider):
+                metrics.inc("dnd_llm_hedges_total", provider=provider, model=model)
+                tasks.add(asyncio.ensure_future(_atimed(acall, key)))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                metrics.inc("dnd_llm_timeouts_total", provider=provider, model=model)
+                raise TimeoutError(f"{key} did not respond within the deadline")
+            if successes := [task for task in done if task.exception() is None]:
+                if successes[0] is not primary:
+                    metrics.inc("dnd_llm_hedge_wins_total", provider=provider, model=model)
+                return successes[0].result()
+            if not tasks:
+                return done.pop().result()
+    finally:
+        # Unlike threads, the requests that lost or timed out can be cancelled
+        for task in tasks:
+            task.cancel()
+
+async def aresilient_call(
+    acall: Callable[[], Awaitable],
+    provider: str,
+    model: str,
+    timeout: float = llm_timeout_seconds,
+    hedge: bool = llm_hedging_enabled,
+) -> Any:
+    """Asynchronous resilient_call, taking a function that returns the request's awaitable."""
+    deadline = time.monotonic() + timeout
+    for attempt in range(llm_max_retries + 1):
+        try:
+            return await _aattempt(acall, provider, model, deadline, hedge)
+        except Exception as e:
+            delay = _retry_delay(attempt)
+            if attempt == llm_max_retries or not is_transient(e) or delay >= deadline - time.monotonic():
+                raise
+            metrics.inc("dnd_llm_retries_total", provider=provider, model=model)
+            metrics.log("llm_retry", provider=provider, model=model, attempt=attempt + 1, delay_seconds=delay, error=str(e))
+            await asyncio.sleep(delay)
+
+def wait_for_rate_limit(provider: str, timeout: float = llm_timeout_seconds):
+    """Wait for the provider's rate limit, for requests that are not made through resilient_call, e.g. streams."""
+    time.sleep(_reserve(provider, time.monotonic() + timeout))
+
+def resilient_runnable(runnable, provider: str, model: str):
+    """Wrap a LangChain runnable, e.g. a structured chat model, so every invoke goes through resilient_call."""
+    from langchain_core.runnables import RunnableLambda
+
+    def invoke(input, config):
+        return resilient_call(lambda: runnable.invoke(input, config), provider, model)
+    return RunnableLambda(invoke, name=f"resilient_{provider}")
@@ -0,0 +1,171 @@
+import threading
+import uuid
+from pathlib import Path
+from typing import List, Optional
+from config import (
+    dnd_converter_outputs_name,
+    semantic_cache_enabled,
+    semantic_cache_threshold,
+    vector_search_mode,
+    vector_index_mmap,
+    vector_search_nprobe,
+)
+from dnd_classes import DND_MAP
+from metrics import metrics
+from output_store import add_output_flush_listener
+from vector_index import VectorIndex, content_hash
+
+def _row_key(description: str, dnd_system: str) -> str:
+    return content_hash(f"{dnd_system}\n{description}")
+
+class SemanticCache:
+    """
+    Cache of converted stat blocks keyed by the meaning of their description.
+
+    The description of every saved result is embedded into its own vector index. A new description whose
+    nearest saved description, for the same system, is at least `threshold` similar gets that result back
+    instead of a graph run, e.g. "a flaming scimitar" and "a metal scimitar engulfed by flame".
+    The index is loaded from the output store on first use and grows as results are saved.
+    """
+
+    def __init__(self, threshold: float = semantic_cache_threshold, enabled: bool = semantic_cache_enabled):
+        self.threshold = threshold
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.index: Optional[VectorIndex] = None
+        self.rows: dict[str, dict] = {}
+        self._embeddings = None
+        # Rows saved while the stored rows are being read, added once the index is installed
+        self._pending: Optional[List[dict]] = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        from rag_tools import get_embeddings, ingest_all_documents
+        with self._lock:
+            if self.index is not None:
+                return
+            if self._pending is None:
+                self._pending = []
+        # Read without holding the lock, which the flush listener takes while the output store is being written
+        documents, _ = ingest_all_documents()
+        with self._lock:
+            if self.index is not None:
+                return
+            self._embeddings = get_embeddings()
+            self.index = VectorIndex(
+                Path(f"{dnd_converter_outputs_name}_descriptions_index"),
+                model=self._embeddings.model,
+                mode=vector_search_mode,
+                mmap=vector_index_mmap,
+                nprobe=vector_search_nprobe,
+            )
+            self._add_rows([doc.metadata["data"] for doc in documents] + self._pending)
+            self._pending = None
+
+    def _add_rows(self, rows: List[dict]):
+        from rag_tools import embed_documents
+        # Later results for the same description and system replace earlier ones
+        new_rows = {}
+        for row in rows:
+            if row.get("description") and row.get("dnd_type") in DND_MAP:
+                key = _row_key(row["description"], row.get("dnd_system") or "")
+                self.rows[key] = row
+                if key not in self.index:
+                    new_rows[key] = row
+        if new_rows:
+            embeddings = embed_documents(self._embeddings, [row["description"] for row in new_rows.values()])
+            self.index.add(list(new_rows), embeddings, [{"dnd_system": row.get("dnd_system") or ""} for row in new_rows.values()])
+
+    def add_rows(self, rows: List[dict]):
+        """Output store flush listener, adding the saved results once the cache is loaded or while it loads."""
+        with self._lock:
+            if self.index is not None:
+                self._add_rows(rows)
+            elif self._pending is not None:
+                self._pending.extend(rows)
+
+    def lookup(self, description: str, dnd_system: str = "D&D 5e") -> Optional[dict]:
+        """
+        Find the saved result with the most similar description for the same system.
+
+        Args:
+            description (str): The description to convert.
+            dnd_system (str): The target system. Defaults to "D&D 5e".
+
+        Returns:
+            Optional[dict]: A graph result (description, dnd_system, dnd_type and the stat block as draft) with the
+                similarity and description it was cached for, None if nothing is similar enough.
+        """
+        from rag_tools import embed_queries, to_dnd_object
+        if not self.enabled:
+            return None
+        with metrics.timer("dnd_semantic_cache_seconds"):
+            self._load()
+            results = self.index.search(embed_queries(self._embeddings, [description])[0], k=1, filter={"dnd_system": dnd_system})
+            row = self.rows.get(results[0][0]) if results and results[0][1] >= self.threshold else None
+            draft = to_dnd_object(row, DND_MAP[row["dnd_type"]]) if row is not None else None
+        with self._lock:
+            if draft is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.inc("dnd_semantic_cache_total", result="miss" if draft is None else "hit")
+        if draft is None:
+            return None
+        return {
+            "description": description,
+            "dnd_system": dnd_system,
+            "dnd_type": row["dnd_type"],
+            "draft": draft,
+            "stop_reason": "semantic_cache",
+            "revisions_saved": 0,
+            "semantic_cache": {"similarity": results[0][1], "description": row["description"]},
+        }
+
+    def stats(self) -> dict:
+        """Hit and miss counters for this process, plus the number of cached results."""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self.rows)}
+
+# Cache shared by every conversion in the process
+semantic_cache = SemanticCache()
+add_output_flush_listener(semantic_cache.add_rows)
+
+def convert(
+    description: str,
+    dnd_system: str = "D&D 5e",
+    max_revisions: int = 1,
+    use_semantic_cache: bool = True,
+    converter=None,
+    thread: Optional[dict] = None,
+) -> dict:
+    """
+    Convert a description to a stat block, from the semantic cache when a near-duplicate was already converted,
+    otherwise with the agent graph.
+
+    Args:
+        description (str): The description to convert.
+        dnd_system (str): The target system. Defaults to "D&D 5e".
+        max_revisions (int): Maximum revisions of the graph run. Defaults to 1.
+        use_semantic_cache (bool): Set to False to always run the graph.
+        converter (dnd_converter | None): The converter running the graph. Defaults to get_converter().
+        thread (Optional[dict]): The graph thread config. Defaults to a new thread.
+
+    Returns:
+        dict: The graph result, with a "semantic_cache" entry for cached results.
+    """
+    if use_semantic_cache:
+        cached = semantic_cache.lookup(description, dnd_system)
+        if cached is not None:
+            return cached
+
+    from agent_dnd_converter import get_converter
+    converter = converter or get_converter()
+    thread = thread or {"configurable": {"thread_id": str(uuid.uuid4())}}
+    result = converter.graph.invoke(
+        {"description": description, "dnd_system": dnd_system, "max_revisions": max_revisions, "revision_number": 0},
+        thread,
+    )
+    converter.mark_completed(thread)
+    return result
@@ -0,0 +1,258 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable
+from config import service_host, service_port, service_max_concurrency, service_max_queue, service_max_body_bytes
+from metrics import metrics
+
+class ServiceError(Exception):
+    """An error answered with an HTTP status code and a JSON error message."""
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+def _description(body: dict) -> str:
+    description = body.get("description")
+    if not isinstance(description, str) or not description.strip():
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "description must be a non-empty string")
+    return description
+
+def effect_params(body: dict) -> dict:
+    return {"description": _description(body)}
+
+def systematise_params(body: dict) -> dict:
+    from config import fused_classify_generate
+    return {
+        "description": _description(body),
+        "system": str(body.get("system") or "D&D 5e"),
+        "fused": bool(body.get("fused", fused_classify_generate)),
+    }
+
+def convert_params(body: dict) -> dict:
+    try:
+        max_revisions = int(body.get("max_revisions", 1))
+    except (TypeError, ValueError):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "max_revisions must be an integer")
+    return {
+        "description": _description(body),
+        "dnd_system": str(body.get("dnd_system") or "D&D 5e"),
+        "max_revisions": max_revisions,
+        "save": bool(body.get("save", True)),
+        "semantic_cache": bool(body.get("semantic_cache", True)),
+    }
+
+async def create_effect(params: dict) -> dict:
+    from effect_creator import acreate_effect
+    return {"effect": await acreate_effect(params["description"])}
+
+async def systematise(params: dict) -> dict:
+    from dnd_converter import asystematise
+    dnd_type, stat_block = await asystematise(params["description"], params["system"], fused=params["fused"])
+    return {"dnd_type": dnd_type, "stat_block": stat_block.model_dump()}
+
+def run_graph(params: dict) -> dict:
+    """
+    Convert one description with the agent graph on the shared converter, or from the semantic cache
+    unless semantic_cache is False, saving a newly converted result unless save is False.
+    """
+    from agent_dnd_converter import save_result_to_file
+    from semantic_cache import convert
+    result = convert(
+        params["description"],
+        params["dnd_system"],
+        params["max_revisions"],
+        use_semantic_cache=params["semantic_cache"],
+        thread={"configurable": {"thread_id": f"service-{uuid.uuid4()}"}},
+    )
+    # A semantic cache hit is already a stored row, saving it again would duplicate it
+    if params["save"] and not result.get("semantic_cache"):
+        save_result_to_file(result)
+    return {
+        "dnd_type": result["dnd_type"],
+        "stat_block": result["draft"].model_dump(),
+        "stop_reason": result.get("stop_reason"),
+        "revisions_saved": result.get("revisions_saved") or 0,
+        "prompt_tokens_saved": result.get("prompt_tokens_saved") or 0,
+        "semantic_cache": result.get("semantic_cache"),
+    }
+
+async def convert(params: dict) -> dict:
+    # Graph nodes are synchronous, so the graph runs on a worker thread while the event loop keeps serving
+    return await asyncio.to_thread(run_graph, params)
+
+# POST endpoints: the function validating the JSON body into the request parameters, and the handler
+ENDPOINTS: dict[str, tuple[Callable[[dict], dict], Callable[[dict], Awaitable[dict]]]] = {
+    "/effects": (effect_params, create_effect),
+    "/systematise": (systematise_params, systematise),
+    "/convert": (convert_params, convert),
+}
+
+class ConverterService:
+    """
+    Asyncio HTTP service running effect creation, systematisation and the agent graph in one warm process.
+
+    At most max_concurrency requests execute at once and up to max_queue more wait for a slot.
+    Requests beyond that are rejected with 503 and a Retry-After header, so clients back off instead of piling up.
+    Concurrent requests with the same endpoint and parameters share one execution and all get its result.
+    """
+
+    def __init__(self, max_concurrency: int = service_max_concurrency, max_queue: int = service_max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.in_flight: dict[str, asyncio.Future] = {}
+
+    async def submit(self, endpoint: str, params: dict) -> tuple[dict, bool]:
+        """Execute a request, or join the identical one in flight. Returns the result and whether it was coalesced."""
+        key = json.dumps([endpoint, params], sort_keys=True)
+        if key in self.in_flight:
+            metrics.inc("dnd_service_coalesced_total", endpoint=endpoint)
+            # Shielded, so a client disconnecting does not cancel the execution the other clients wait for
+            return await asyncio.shield(self.in_flight[key]), True
+        # Requests that will get a slot straight away do not count against the queue
+        if self.active + self.waiting >= self.max_concurrency + self.max_queue:
+            raise ServiceError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many requests queued, retry later")
+
+        # Counted as waiting before the task starts, so requests arriving in the same tick see it
+        self.waiting += 1
+        task = asyncio.ensure_future(self._execute(ENDPOINTS[endpoint][1], params))
+        self.in_flight[key] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(task), False
+
+    async def _execute(self, handler: Callable[[dict], Awaitable[dict]], params: dict) -> dict:
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            return await handler(params)
+        finally:
+            self.active -= 1
+            self.slots.release()
+
+    async def dispatch(self, method: str, path: str, body: bytes) -> tuple[HTTPStatus, Any, dict]:
+        """Answer one request, returning the status, the JSON payload (or text) and any extra headers."""
+        path = path.split("?")[0]
+        if method == "GET" and path == "/health":
+            return HTTPStatus.OK, {"status": "ok", "in_flight": len(self.in_flight), "active": self.active, "waiting": self.waiting}, {}
+        if method == "GET" and path == "/metrics":
+            return HTTPStatus.OK, metrics.to_prometheus(), {}
+        if path not in ENDPOINTS:
+            return HTTPStatus.NOT_FOUND, {"error": f"Unknown endpoint: {path}"}, {}
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Use POST"}, {"Allow": "POST"}
+
+        start = time.perf_counter()
+        headers = {}
+        try:
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                raise ServiceError(HTTPStatus.BAD_REQUEST, "Body must be JSON")
+            if not isinstance(request, dict):
+                raise ServiceError(HTTPStatus.BAD_REQUEST, "Body must be a JSON object")
+            result, coalesced = await self.submit(path, ENDPOINTS[path][0](request))
+            status, payload = HTTPStatus.OK, result
+            headers["X-Coalesced"] = "true" if coalesced else "false"
+        except ServiceError as e:
+            status, payload = e.status, {"error": e.message}
+            if status == HTTPStatus.SERVICE_UNAVAILABLE:
+                headers["Retry-After"] = "1"
+        except Exception as e:
+            print(f"Error handling {path}: {e}")
+            status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+        metrics.inc("dnd_service_requests_total", endpoint=path, status=int(status))
+        metrics.observe("dnd_service_request_seconds", time.perf_counter() - start, endpoint=path)
+        return status, payload, headers
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve HTTP/1.1 requests on one connection, keeping it open between requests unless asked to close."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > service_max_body_bytes:
+                    status, payload, extra_headers = HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Body too large"}, {}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload, extra_headers = await self.dispatch(method, path, body)
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                self._write_response(writer, status, payload, extra_headers, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Clients that disconnect or send malformed requests just lose their connection
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, status: HTTPStatus, payload: Any, headers: dict, keep_alive: bool):
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        lines = [
+            f"HTTP/1.1 {status.value} {status.phrase}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            *(f"{name}: {value}" for name, value in headers.items()),
+        ]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+async def serve(
+    host: str = service_host,
+    port: int = service_port,
+    max_concurrency: int = service_max_concurrency,
+    max_queue: int = service_max_queue,
+    warm: bool = True,
+):
+    """Run the service until cancelled, warming the converter and the example index first."""
+    if warm:
+        def warm_up():
+            from agent_dnd_converter import get_converter
+            from rag_tools import get_index_retriever
+            get_converter()
+            get_index_retriever()
+        await asyncio.to_thread(warm_up)
+    service = ConverterService(max_concurrency=max_concurrency, max_queue=max_queue)
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f"Serving on http://{host}:{server.sockets[0].getsockname()[1]} (POST /effects, /systematise, /convert; GET /health, /metrics)")
+    async with server:
+        await server.serve_forever()
+
+def main():
+    """Serve the converters over HTTP"""
+    parser = argparse.ArgumentParser(description="Serve effect creation, systematisation and the agent converter over HTTP.")
+    parser.add_argument("--host", default=service_host, help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=service_port, help="Port to listen on")
+    parser.add_argument("--max-concurrency", type=int, default=service_max_concurrency, help="Requests executed at once")
+    parser.add_argument("--max-queue", type=int, default=service_max_queue, help="Requests waiting before new ones get 503")
+    parser.add_argument("--no-warm", action="store_true", help="Do not build the converter and example index before serving")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_concurrency, args.max_queue, warm=not args.no_warm))
+    except KeyboardInterrupt:
+        # Buffered results are written by the output store on exit
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import hashlib
+import json
+import threading
+from pathlib import Path
+from typing import Any, List, Literal, Optional, Tuple
+import numpy as np
+
+INDEX_FORMAT_VERSION = 2
+
+def content_hash(text: str) -> str:
+    """Return the sha256 hex digest used to key documents in the index."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _normalise(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, highest first."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+class VectorIndex:
+    """
+    Append-only on-disk embedding index, keyed by content hash.
+
+    The index is stored as files sharing a path prefix:
+        <prefix>.f32     contiguous float32 matrix of unit-normalised embeddings, one row per document
+        <prefix>.jsonl   one line per row holding the content hash and the filterable metadata of the document
+        <prefix>.json    index metadata (format, embedding model, dimension and IVF parameters)
+        <prefix>.ivf.npy IVF centroids, only for the approximate search mode
+        <prefix>.ivf.i32 IVF list assignment of every row, only for the approximate search mode
+
+    Rows are only ever appended, so documents that are already indexed are never re-embedded.
+
+    Searches can be restricted to rows whose metadata matches a filter, e.g. {"dnd_type": "Spell", "spell_level": [1, 2]}.
+    The filter is applied before scoring, as a mask over the rows, so it always returns the k best matching rows.
+
+    Two search modes are available:
+        exact        cosine similarity of the query against every row, as one batched matrix product
+        approximate  inverted file (IVF) search, scoring only the rows in the nprobe lists whose
+                     centroids are closest to the query. Raising nprobe trades latency for recall.
+    """
+
+    def __init__(
+        self,
+        path_prefix: str | Path,
+        model: str,
+        mode: Literal["exact", "approximate"] = "exact",
+        mmap: bool = False,
+        nprobe: int = 8,
+        approximate_min_rows: int = 10000,
+    ):
+        self.path_prefix = Path(path_prefix)
+        self.vectors_path = self._path(".f32")
+        self.hashes_path = self._path(".jsonl")
+        self.meta_path = self._path(".json")
+        self.centroids_path = self._path(".ivf.npy")
+        self.assignments_path = self._path(".ivf.i32")
+        self.model = model
+        self.mode = mode
+        self.mmap = mmap
+        self.nprobe = nprobe
+        self.approximate_min_rows = approximate_min_rows
+        self.meta = {}
+        self.reset()
+        self.load()
+
+    def _path(self, suffix: str) -> Path:
+        return self.path_prefix.with_name(self.path_prefix.name + suffix)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, text_hash: str) -> bool:
+        return text_hash in self.positions
+
+    @property
+    def dim(self) -> int | None:
+        return self.meta.get("dim")
+
+    def reset(self):
+        """Reset the in-memory state, leaving the files on disk untouched."""
+        self.meta = {}
+        self.hashes: List[str] = []
+        self.metadata: List[dict] = []
+        self.positions: dict[str, int] = {}
+        # Metadata columns as integer codes, built on the first filter on each field: (codes, code by value)
+        self._columns: dict[str, tuple[np.ndarray, dict[str, int]]] = {}
+        self._columns_lock = threading.Lock()
+        # Guards IVF training and assignment, which would otherwise run once per concurrent first search
+        self._ivf_lock = threading.RLock()
+        self._buffer = np.zeros((0, 0), dtype=np.float32)
+        self.embeddings = self._buffer
+        self._reset_ivf()
+
+    def _reset_ivf(self):
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self._lists = None
+
+    def load(self):
+        """Load the index from disk, discarding it if it was built with a different embedding model or format."""
+        if not self.meta_path.exists():
+            return
+        meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+        if meta.get("model") != self.model or meta.get("format") != INDEX_FORMAT_VERSION:
+            print(f"Index {self.path_prefix} was built with {meta.get('model')}, rebuilding for {self.model}...")
+            self.clear()
+            return
+
+        self.meta = meta
+        records = []
+        if self.hashes_path.exists():
+            with open(self.hashes_path, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        hashes = [record["hash"] for record in records]
+        stored_rows = self.vectors_path.stat().st_size // (4 * self.dim) if self.vectors_path.exists() else 0
+
+        # A crash between the two appends can leave one file a row ahead of the other
+        rows = min(len(hashes), stored_rows)
+        self.hashes = hashes[:rows]
+        self.metadata = [record.get("metadata", {}) for record in records[:rows]]
+        self.positions = {text_hash: i for i, text_hash in enumerate(self.hashes)}
+        self._load_vectors(rows)
+        if self.mode == "approximate":
+            self._load_ivf()
+
+    def _load_vectors(self, rows: int):
+        if rows == 0:
+            self._buffer = np.zeros((0, self.dim), dtype=np.float32)
+        elif self.mmap:
+            self._buffer = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        else:
+            self._buffer = np.fromfile(self.vectors_path, dtype=np.float32, count=rows * self.dim).reshape(rows, self.dim)
+        self.embeddings = self._buffer[:rows]
+
+    def clear(self):
+        """Remove the index files and reset the in-memory state."""
+        for path in (self.vectors_path, self.hashes_path, self.meta_path, self.centroids_path, self.assignments_path):
+            path.unlink(missing_ok=True)
+        self.reset()
+
+    def _write_meta(self):
+        self.meta_path.write_text(json.dumps(self.meta), encoding="utf-8")
+
+    def add(self, hashes: List[str], embeddings: List[List[float]], metadata: Optional[List[dict]] = None):
+        """Append embeddings for new content hashes to the index, on disk and in memory, with optional filterable metadata per row."""
+        if not hashes:
+            return
+        metadata = metadata or [{} for _ in hashes]
+        vectors = _normalise(np.asarray(embeddings, dtype=np.float32))
+        if self.dim is None:
+            self.meta = {"format": INDEX_FORMAT_VERSION, "model": self.model, "dim": vectors.shape[1]}
+            self._write_meta()
+            self._load_vectors(0)
+
+        with open(self.vectors_path, "ab") as f:
+            vectors.tofile(f)
+        with open(self.hashes_path, "a", encoding="utf-8") as f:
+            f.writelines(
+                json.dumps({"hash": text_hash, "metadata": row_metadata} if row_metadata else {"hash": text_hash}) + "\n"
+                for text_hash, row_metadata in zip(hashes, metadata)
+            )
+
+        # Hashes and metadata go first, so a concurrent search never sees a row without them
+        start = len(self.hashes)
+        self.metadata.extend(metadata)
+        self.hashes.extend(hashes)
+        self.positions.update({text_hash: start + i for i, text_hash in enumerate(hashes)})
+        self._append_vectors(vectors)
+        if self.mode == "approximate" and self.centroids is not None:
+            self._assign_new_rows()
+
+    def _append_vectors(self, vectors: np.ndarray):
+        rows = len(self.embeddings) + len(vectors)
+        if self.mmap:
+            self._load_vectors(rows)
+            return
+        # Grow the contiguous buffer geometrically, so single-row appends stay cheap
+        if rows > len(self._buffer):
+            buffer = np.empty((max(rows, 2 * len(self._buffer)), self.dim), dtype=np.float32)
+            buffer[: len(self.embeddings)] = self.embeddings
+            self._buffer = buffer
+        self._buffer[len(self.embeddings) : rows] = vectors
+        self.embeddings = self._buffer[:rows]
+
+    def _column(self, field: str) -> tuple[np.ndarray, dict[str, int]]:
+        # Extend the column with the rows added since it was last built, missing values get code -1
+        with self._columns_lock:
+            codes, vocabulary = self._columns.get(field, (np.zeros(0, dtype=np.int32), {}))
+            metadata = self.metadata
+            if len(codes) < len(metadata):
+                new_codes = [
+                    vocabulary.setdefault(str(row[field]), len(vocabulary)) if row.get(field) is not None else -1
+                    for row in metadata[len(codes):]
+                ]
+                codes = np.concatenate([codes, np.asarray(new_codes, dtype=np.int32)])
+                self._columns[field] = (codes, vocabulary)
+            return codes, vocabulary
+
+    def filter_mask(self, filter: dict[str, Any], rows: Optional[int] = None) -> np.ndarray:
+        """
+        Boolean mask of the rows whose metadata matches the filter.
+
+        Args:
+            filter (dict[str, Any]): Allowed value, or list of allowed values, per metadata field. Every field must match.
+            rows (Optional[int]): Number of rows to mask. Defaults to every row.
+
+        Returns:
+            np.ndarray: True for each matching row.
+        """
+        rows = len(self) if rows is None else rows
+        mask = np.ones(rows, dtype=bool)
+        for field, allowed in filter.items():
+            allowed = allowed if isinstance(allowed, (list, tuple, set)) else [allowed]
+            codes, vocabulary = self._column(field)
+            allowed_codes = [vocabulary[str(value)] for value in allowed if str(value) in vocabulary]
+            if len(allowed_codes) == 1:
+                mask &= codes[:rows] == allowed_codes[0]
+            else:
+                mask &= np.isin(codes[:rows], allowed_codes)
+        return mask
+
+    def search(self, query_embedding: List[float], k: int = 2, filter: Optional[dict[str, Any]] = None) -> List[Tuple[str, float]]:
+        """
+        Find the k indexed documents most similar to the query embedding.
+
+        Args:
+            query_embedding (List[float]): The embedded query.
+            k (int): Number of results to return. Defaults to 2.
+            filter (Optional[dict[str, Any]]): Only search rows whose metadata matches, see filter_mask. Defaults to every row.
+
+        Returns:
+            List[Tuple[str, float]]: (content hash, cosine similarity) pairs, most similar first.
+        """
+        return self.search_batch([query_embedding], k=k, filter=filter)[0]
+
+    def search_batch(self, query_embeddings: List[List[float]], k: int = 2, filter: Optional[dict[str, Any]] = None) -> List[List[Tuple[str, float]]]:
+        """Search several embedded queries at once, with the same filter. Returns one result list per query."""
+        # Snapshot the rows, so a concurrent add cannot change them mid-search
+        embeddings = self.embeddings
+        if len(embeddings) == 0:
+            return [[] for _ in query_embeddings]
+        queries = _normalise(np.asarray(query_embeddings, dtype=np.float32))
+        mask = self.filter_mask(filter, rows=len(embeddings)) if filter else None
+        matching_rows = len(embeddings) if mask is None else int(mask.sum())
+        if matching_rows == 0:
+            return [[] for _ in query_embeddings]
+
+        if self.mode == "approximate" and matching_rows >= self.approximate_min_rows:
+            lists = self._ivf_lists()
+            results = [self._search_ivf(lists, query, k, mask) for query in queries]
+            # A selective filter can leave the probed lists with fewer than k matching rows
+            results = [
+                result if len(result) >= min(k, matching_rows) else self._search_exact(embeddings, query[None, :], k, mask)[0]
+                for query, result in zip(queries, results)
+            ]
+        else:
+            results = self._search_exact(embeddings, queries, k, mask)
+        return [[(self.hashes[i], float(score)) for i, score in result] for result in results]
+
+    def _search_exact(
+        self, embeddings: np.ndarray, queries: np.ndarray, k: int, mask: Optional[np.ndarray] = None, block_rows: int = 65536
+    ) -> List[List[Tuple[int, float]]]:
+        # Score the matrix in blocks, so memory-mapped indexes are never fully materialised.
+        # Gathering rows costs several times more per row than scoring contiguous ones, so only the rows of
+        # a selective filter are gathered, other filters score every row and discard those that do not match
+        positions = np.flatnonzero(mask) if mask is not None and mask.mean() < 0.125 else None
+        rows = len(embeddings) if positions is None else len(positions)
+        candidates = [[] for _ in queries]
+        for start in range(0, rows, block_rows):
+            if positions is None:
+                block_positions = np.arange(start, min(start + block_rows, rows))
+                scores = embeddings[start : start + block_rows] @ queries.T
+                if mask is not None:
+                    scores[~mask[start : start + block_rows]] = -np.inf
+            else:
+                block_positions = positions[start : start + block_rows]
+                scores = embeddings[block_positions] @ queries.T
+            for q in range(len(queries)):
+                top = _top_k(scores[:, q], k)
+                top = top[np.isfinite(scores[top, q])]
+                candidates[q].extend(zip(block_positions[top].tolist(), scores[top, q].tolist()))
+        return [sorted(found, key=lambda item: -item[1])[:k] for found in candidates]
+
+    # Approximate (IVF) search
+    def _load_ivf(self):
+        if not self.centroids_path.exists() or "ivf_trained_rows" not in self.meta:
+            return
+        self.centroids = np.load(self.centroids_path)
+        stored = np.fromfile(self.assignments_path, dtype=np.int32) if self.assignments_path.exists() else np.zeros(0, dtype=np.int32)
+        self.assignments = stored[: len(self)]
+        self._lists = None
+        self._assign_new_rows()
+
+    def train(self, iterations: int = 8, sample_per_list: int = 64, seed: int = 0):
+        """
+        Cluster the index rows into sqrt(n) inverted lists with spherical k-means and assign every row to one.
+        Training runs automatically on the first approximate search and again once the index has grown 4x.
+        """
+        with self._ivf_lock:
+            embeddings = self.embeddings
+            rows = len(embeddings)
+            nlist = int(np.clip(np.sqrt(rows), 1, 4096))
+            print(f"Training IVF index {self.path_prefix} with {nlist} lists over {rows} rows...")
+            rng = np.random.default_rng(seed)
+            sample = embeddings[np.sort(rng.choice(rows, size=min(rows, nlist * sample_per_list), replace=False))]
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(iterations):
+                nearest = np.argmax(sample @ centroids.T, axis=1)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, nearest, sample)
+                empty = ~sums.any(axis=1)
+                sums[empty] = centroids[empty]
+                centroids = _normalise(sums)
+
+            self.centroids = centroids
+            np.save(self.centroids_path, centroids)
+            self.assignments = np.zeros(0, dtype=np.int32)
+            self.assignments_path.unlink(missing_ok=True)
+            self.meta["ivf_trained_rows"] = rows
+            self._write_meta()
+            self._assign_new_rows()
+
+    def _assign_new_rows(self, block_rows: int = 65536):
+        with self._ivf_lock:
+            # Count the vectors, not the hashes, which a concurrent add extends first
+            embeddings = self.embeddings
+            rows = len(embeddings)
+            if rows > 4 * self.meta.get("ivf_trained_rows", rows):
+                self.train()
+                return
+            start = len(self.assignments)
+            if start >= rows:
+                return
+            new_assignments = np.concatenate([
+                np.argmax(embeddings[block : min(block + block_rows, rows)] @ self.centroids.T, axis=1).astype(np.int32)
+                for block in range(start, rows, block_rows)
+            ])
+            with open(self.assignments_path, "ab") as f:
+                new_assignments.tofile(f)
+            self.assignments = np.concatenate([self.assignments, new_assignments])
+            self._lists = None
+
+    def _ivf_lists(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Train on the first approximate search and snapshot (centroids, rows by list, list offsets) together,
+        # so a search never pairs the centroids of one training with the assignments of another
+        with self._ivf_lock:
+            if self.centroids is None:
+                self.train()
+            if self._lists is None:
+                order = np.argsort(self.assignments, kind="stable")
+                offsets = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+                self._lists = (self.centroids, order, offsets)
+            return self._lists
+
+    def _search_ivf(
+        self, lists: tuple[np.ndarray, np.ndarray, np.ndarray], query: np.ndarray, k: int, mask: Optional[np.ndarray] = None
+    ) -> List[Tuple[int, float]]:
+        centroids, order, offsets = lists
+        probes = _top_k(centroids @ query, self.nprobe)
+        candidates = np.concatenate([order[offsets[p] : offsets[p + 1]] for p in probes])
+        if mask is not None:
+            candidates = candidates[candidates < len(mask)]
+            candidates = candidates[mask[candidates]]
+        if len(candidates) == 0:
+            return []
+        # Read rows in file order, which keeps memory-mapped access sequential
+        candidates = np.sort(candidates)
+        scores = self.embeddings[candidates] @ query
+        top = _top_k(scores, k)
+        return list(zip(candidates[top].tolist(), scores[top].tolist()))